@@ -1,12 +1,27 @@
 import tkinter as tk
 from tkinter import Canvas
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, ImageDraw, ImageFont
 import random
 import os
+import sys
+import math
 import json
 import time
+import hashlib
+import zlib
+import threading
+import queue
+import heapq
+import itertools
+import bisect
+import base64
+import socket
+import select
+from stat import S_ISSOCK
+from array import array
+from collections import OrderedDict, deque
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 
 try:
@@ -22,6 +37,12 @@ except ImportError:
     HAS_PYGAME = False
     print("Warning: pygame not installed. Audio features disabled.")
 
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
 # Constants
 class Constants:
     # State decay rates
@@ -37,14 +58,49 @@ class Constants:
     HAPPINESS_THRESHOLD_LOW = 40
     HAPPINESS_THRESHOLD_HIGH = 70
     HAPPINESS_THRESHOLD_VERY_HIGH = 85
+    MAX_MOOD_RULES = 32
+    MAX_MOOD_TABLE_SIZE = 4096
     
-    # Time related
-    SAVE_INTERVAL = 3000
+    # Timers (seconds)
+    SAVE_INTERVAL = 150
+    CONFIG_CHECK_INTERVAL = 1.0
     WEATHER_UPDATE_INTERVAL = 1800
-    ANIMATION_DELAY = 50
+    WEATHER_RETRY_INTERVAL = 60
     DOUBLE_CLICK_TIME = 0.3
+    
+    # Animation (delays in milliseconds)
+    ANIMATION_DELAY = 50
+    IDLE_MAX_DELAY = 1000
+    MOTION_FRAME_DELAY = 16
     FRAME_SPEED = 5
     
+    # Drag momentum
+    MOMENTUM_FRICTION = 3.0
+    MOMENTUM_BOUNCE = 0.5
+    MOMENTUM_MIN_SPEED = 40
+    MOMENTUM_MAX_SPEED = 4000
+    MOMENTUM_SAMPLE_WINDOW = 0.1
+    
+    # Wandering
+    WANDER_SPEED = 70
+    WANDER_MIN_SPEED_FACTOR = 0.3
+    WANDER_IDLE_TIME = (2.0, 6.0)
+    WANDER_PERCH_TIME = (10.0, 30.0)
+    WANDER_PERCH_CHANCE = 0.15
+    
+    # Frame sizes
+    PET_SIZES = (100, 150, 200, 250)
+    MIN_PET_SIZE = 50
+    MAX_PET_SIZE = 500
+    FRAME_CACHE_SIZES = 3
+    HQ_FRAMES_PER_TICK = 8
+    TINT_CACHE_SIZE = 4
+    
+    # Local control API
+    IPC_POLL_DELAY = 50
+    IPC_MAX_LINE = 65536
+    IPC_MAX_BUFFER = 262144
+    
     # API
     WEATHER_TIMEOUT = 5
     WEATHER_API_URL = "https://api.open-meteo.com/v1/forecast"
@@ -61,6 +117,12 @@ class Constants:
     BUBBLE_BG = "#FFE5B4"
     BUBBLE_OUTLINE = "#FFB347"
     BUBBLE_TEXT_COLOR = "#4A3728"
+    BUBBLE_CACHE_SIZE = 32
+    BUBBLE_FONT_SIZE = 12
+    BUBBLE_FONTS = ("Helvetica.ttc", "Arial Bold.ttf", "arialbd.ttf", "DejaVuSans-Bold.ttf")
+    # Offscreen status text; symbol-rich fonts first for the weather emoji
+    STATUS_FONT_SIZE = 12
+    STATUS_FONTS = ("seguisym.ttf", "Arial Unicode.ttf", "DejaVuSans.ttf", "Helvetica.ttc", "arial.ttf")
     
     # Weather window colors
     WEATHER_BG = "#4A90E2"
@@ -68,6 +130,22 @@ class Constants:
     WEATHER_CARD_BG = "#5BA3E8"
     WEATHER_TEXT = "#FFFFFF"
     
+    # History chart colors
+    HISTORY_BG = "#FFF9E6"
+    HISTORY_GRID = "#E8DCC0"
+    HISTORY_SATIATION = "#E67E22"
+    HISTORY_ENERGY = "#3498DB"
+    HISTORY_HAPPINESS = "#E74C3C"
+    
+    # Stats history
+    HISTORY_SAMPLE_INTERVAL = 10
+    HISTORY_RAW_CAPACITY = 3600
+    HISTORY_LEVELS = (
+        ("minute", 60, 1440),
+        ("hour", 3600, 720),
+        ("day", 86400, 365),
+    )
+    
     # Audio
     DEFAULT_VOLUME = 0.5
     BGM_VOLUME = 0.3
@@ -83,6 +161,62 @@ class Mood(Enum):
     EXCITED = "excited"
     MOST_ANGRY = "most_angry"
 
+class TimerHandle:
+    """A scheduled callback; cancel() prevents it from running"""
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+    
+    def __init__(self, deadline: float, callback, args: tuple):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler:
+    """Deadline scheduler keyed on time.monotonic()
+    
+    Deadlines live in a heap, so each tick only touches expired timers.
+    Cancelled timers are dropped lazily when they reach the top.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._heap: List[Tuple[float, int, TimerHandle]] = []
+        self._counter = itertools.count()
+    
+    def call_at(self, deadline: float, callback, *args) -> TimerHandle:
+        if not math.isfinite(deadline):
+            # A NaN or infinite deadline would block every timer behind it
+            raise ValueError(f"invalid timer deadline: {deadline}")
+        handle = TimerHandle(deadline, callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+        return handle
+    
+    def call_later(self, delay: float, callback, *args) -> TimerHandle:
+        return self.call_at(self.clock() + delay, callback, *args)
+    
+    def next_deadline(self) -> Optional[float]:
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+    
+    def run_due(self, now: Optional[float] = None) -> int:
+        """Run every timer whose deadline has passed, return how many ran"""
+        if now is None:
+            now = self.clock()
+        ran = 0
+        while self._heap and self._heap[0][0] <= now:
+            _, _, handle = heapq.heappop(self._heap)
+            if handle.cancelled:
+                continue
+            ran += 1
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f"Timer callback failed: {e}")
+        return ran
+
 class AudioManager:
     """Audio management class - simplified version"""
     def __init__(self, sounds_dir: str = "sounds", enable_audio: bool = True):
@@ -185,12 +319,26 @@ class AudioManager:
 
 class Config:
     """Configuration management class"""
+    # Numeric settings that must be in range before any subsystem uses them
+    NUMERIC_RANGES = {
+        "pet_size": (Constants.MIN_PET_SIZE, Constants.MAX_PET_SIZE),
+        "sfx_volume": (0.0, 1.0),
+        "bgm_volume": (0.0, 1.0),
+        "latitude": (-90.0, 90.0),
+        "longitude": (-180.0, 180.0),
+    }
+    
     def __init__(self, config_file: str = "pet_config.json"):
         self.config_file = config_file
+        self._file_stamp = self._get_file_stamp()
         self.config = self.load_config()
+        # Last contents seen on disk; reloads diff against this, not against
+        # the running config, so runtime changes (menu choices) survive
+        self._file_config = dict(self.config)
     
-    def load_config(self) -> dict:
-        default_config = {
+    @staticmethod
+    def default_config() -> dict:
+        return {
             "pet_size": 150,
             "latitude": Constants.DEFAULT_LATITUDE,
             "longitude": Constants.DEFAULT_LONGITUDE,
@@ -203,6 +351,34 @@ class Config:
             "sfx_volume": Constants.SFX_VOLUME,
             "bgm_volume": Constants.BGM_VOLUME,
             "sounds_dir": "sounds",
+            "sprite_atlas": "off",
+            "weather_tint": True,
+            "power_saving": False,
+            "drag_momentum": False,
+            "wander": False,
+            "enable_ipc": False,
+            "ipc_socket": "pet.sock",
+            "record_session": "",
+            "mood_rules": [
+                {"mood": "normal", "priority": 60,
+                 "below": {"energy": Constants.ENERGY_THRESHOLD_LOW}},
+                {"mood": "upset", "priority": 50,
+                 "below": {"satiation": Constants.HUNGER_THRESHOLD_LOW}},
+                {"mood": "angry", "priority": 40,
+                 "below": {"satiation": Constants.HUNGER_THRESHOLD_MEDIUM}},
+                {"mood": "love", "priority": 30,
+                 "above": {"happiness": Constants.HAPPINESS_THRESHOLD_VERY_HIGH}},
+                {"mood": "happy", "priority": 20,
+                 "above": {"happiness": Constants.HAPPINESS_THRESHOLD_HIGH}},
+                {"mood": "most_angry", "priority": 10,
+                 "below": {"happiness": Constants.HAPPINESS_THRESHOLD_LOW}},
+                {"mood": "normal", "priority": 0}
+            ],
+            "action_effects": {
+                "feed": {"energy": -5, "happiness": 5, "mood": "happy"},
+                "play": {"energy": -20, "satiation": -10, "mood": "excited"},
+                "sleep": {"energy": 100, "satiation": -5, "happiness": 5, "mood": "normal"}
+            },
             "foods": {
                 "Rice": 30,
                 "Meat": 50,
@@ -216,6 +392,9 @@ class Config:
                 "Chat": 20
             }
         }
+    
+    def load_config(self) -> dict:
+        default_config = self.default_config()
         
         try:
             if os.path.exists(self.config_file):
@@ -226,15 +405,66 @@ class Config:
         except Exception as e:
             print(f"Config load failed: {e}")
         
-        return default_config
+        return self._validate(default_config, self.default_config())
+    
+    def _validate(self, config: dict, fallback: dict) -> dict:
+        """Replace mistyped or out-of-range values with the fallback ones"""
+        for key, (low, high) in self.NUMERIC_RANGES.items():
+            value = config.get(key)
+            valid = (isinstance(value, (int, float)) and not isinstance(value, bool)
+                     and low <= value <= high)
+            if key == "pet_size":
+                valid = valid and isinstance(value, int)
+            if not valid:
+                print(f"Config value {key}={value!r} ignored, expected {low} to {high}")
+                config[key] = fallback.get(key)
+        return config
     
     def save_config(self):
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(self.config, f, indent=2, ensure_ascii=False)
+            # Our own write should not be picked up as an external edit
+            self._file_stamp = self._get_file_stamp()
+            self._file_config = dict(self.config)
         except Exception as e:
             print(f"Config save failed: {e}")
     
+    def _get_file_stamp(self) -> Optional[tuple]:
+        try:
+            info = os.stat(self.config_file)
+            return (info.st_mtime_ns, info.st_size)
+        except OSError:
+            return None
+    
+    def reload_if_changed(self) -> dict:
+        """Re-read the config file if it changed on disk, return changed keys"""
+        stamp = self._get_file_stamp()
+        if stamp == self._file_stamp:
+            return {}
+        self._file_stamp = stamp
+        if stamp is None:
+            # File was removed; keep running config, it is rewritten on exit
+            return {}
+        
+        new_config = self.default_config()
+        try:
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                new_config.update(json.load(f))
+        except Exception as e:
+            # Keep running config if the file is mid-write or invalid
+            print(f"Config reload failed: {e}")
+            return {}
+        self._validate(new_config, self._file_config)
+        
+        changes = {
+            key: value for key, value in new_config.items()
+            if self._file_config.get(key) != value
+        }
+        self._file_config = new_config
+        self.config.update(changes)
+        return changes
+    
     def get(self, key: str, default=None):
         return self.config.get(key, default)
     
@@ -349,9 +579,6 @@ class WeatherService:
                 break
         
         return f"{emoji} {desc}, {temp}°C"
-    
-    def should_update(self) -> bool:
-        return time.time() - self.last_update > Constants.WEATHER_UPDATE_INTERVAL
 
 class WeatherWindow:
     """Weather detail window"""
@@ -533,22 +760,173 @@ class WeatherWindow:
         )
         temp_text.pack()
 
+class MoodRules:
+    """Mood transitions and action effects compiled from config
+    
+    A rule picks a mood when every stat in "below" is under and every stat
+    in "above" is over its threshold; the highest priority match wins.
+    Thresholds split each stat into buckets (between or exactly on a
+    threshold) and the rules are evaluated once per bucket combination,
+    so choosing a mood is a bisect per stat and one table lookup.
+    """
+    STATS = ("satiation", "energy", "happiness")
+    ACTIONS = ("feed", "play", "sleep")
+    
+    def __init__(self, mood_rules: List[dict], action_effects: Dict[str, dict]):
+        rules = self._validate_rules(mood_rules)
+        if not isinstance(action_effects, dict):
+            raise ValueError("action_effects must be an object")
+        defaults = Config.default_config()["action_effects"]
+        unknown = set(action_effects) - set(self.ACTIONS)
+        if unknown:
+            raise ValueError(f"unknown actions: {', '.join(sorted(unknown))}")
+        for name, effect in action_effects.items():
+            if not isinstance(effect, dict):
+                raise ValueError(f"effect for {name} must be an object")
+        # Configured entries override single fields of the default effect
+        effects = {name: {**defaults[name], **action_effects.get(name, {})} for name in self.ACTIONS}
+        self.effects = self._validate_effects(effects)
+        self.source = {"mood_rules": mood_rules, "action_effects": effects}
+        
+        self.cuts = {stat: [] for stat in self.STATS}
+        for rule in rules:
+            for key in ("below", "above"):
+                for stat, threshold in rule.get(key, {}).items():
+                    self.cuts[stat].append(float(threshold))
+        self.cuts = {stat: sorted(set(cuts)) for stat, cuts in self.cuts.items()}
+        self._cut_lists = [self.cuts[stat] for stat in self.STATS]
+        self._sizes = [2 * len(cuts) + 1 for cuts in self._cut_lists]
+        if math.prod(self._sizes) > Constants.MAX_MOOD_TABLE_SIZE:
+            raise ValueError(f"mood rules use too many distinct thresholds "
+                             f"({math.prod(self._sizes)} table entries, "
+                             f"at most {Constants.MAX_MOOD_TABLE_SIZE})")
+        
+        # Row-major over (satiation, energy, happiness) buckets
+        ordered = sorted(rules, key=lambda rule: -rule.get("priority", 0))
+        self.table: List[Mood] = [
+            self._match(ordered, dict(zip(self.STATS, values)))
+            for values in itertools.product(*(self._representatives(c) for c in self._cut_lists))
+        ]
+        moods = list(Mood)
+        self.index_table = [moods.index(mood) for mood in self.table]
+        if HAS_NUMPY:
+            self._index_array = np.array(self.index_table, dtype=np.int8)
+    
+    @classmethod
+    def default(cls) -> "MoodRules":
+        defaults = Config.default_config()
+        return cls(defaults["mood_rules"], defaults["action_effects"])
+    
+    @classmethod
+    def from_config(cls, config: "Config") -> "MoodRules":
+        """Compile the configured rules, falling back to the defaults if invalid"""
+        try:
+            return cls(config.get("mood_rules"), config.get("action_effects", {}))
+        except Exception as e:
+            print(f"Mood rules load failed: {e}")
+            return cls.default()
+    
+    @classmethod
+    def _validate_rules(cls, rules: List[dict]) -> List[dict]:
+        if not isinstance(rules, list) or not rules:
+            raise ValueError("mood_rules must be a non-empty list")
+        if len(rules) > Constants.MAX_MOOD_RULES:
+            raise ValueError(f"at most {Constants.MAX_MOOD_RULES} mood rules are allowed")
+        for i, rule in enumerate(rules):
+            if not isinstance(rule, dict):
+                raise ValueError(f"mood rule {i} must be an object")
+            unknown = set(rule) - {"mood", "priority", "below", "above"}
+            if unknown:
+                raise ValueError(f"mood rule {i} has unknown keys: {', '.join(sorted(unknown))}")
+            Mood(rule.get("mood"))
+            if not cls._is_number(rule.get("priority", 0)):
+                raise ValueError(f"mood rule {i} priority must be a number")
+            for key in ("below", "above"):
+                conditions = rule.get(key, {})
+                if not isinstance(conditions, dict):
+                    raise ValueError(f"mood rule {i} {key} must be an object")
+                for stat, threshold in conditions.items():
+                    if stat not in cls.STATS or not cls._is_number(threshold):
+                        raise ValueError(f"mood rule {i} has invalid {key} condition: {stat}")
+        return rules
+    
+    @classmethod
+    def _validate_effects(cls, effects: Dict[str, dict]) -> Dict[str, tuple]:
+        compiled = {}
+        for name, effect in effects.items():
+            for key, value in effect.items():
+                if key != "mood" and (key not in cls.STATS or not cls._is_number(value)):
+                    raise ValueError(f"effect for {name} has invalid entry: {key}")
+            mood = Mood(effect["mood"]) if "mood" in effect else None
+            compiled[name] = tuple(float(effect.get(stat, 0)) for stat in cls.STATS) + (mood,)
+        return compiled
+    
+    @staticmethod
+    def _is_number(value) -> bool:
+        return (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and math.isfinite(value))
+    
+    @staticmethod
+    def _representatives(cuts: List[float]) -> List[float]:
+        """One value per bucket: below, on and between the thresholds"""
+        if not cuts:
+            return [0.0]
+        values = [cuts[0] - 1]
+        for i, cut in enumerate(cuts):
+            values.append(cut)
+            values.append((cut + cuts[i + 1]) / 2 if i + 1 < len(cuts) else cut + 1)
+        return values
+    
+    @staticmethod
+    def _match(rules: List[dict], stats: Dict[str, float]) -> Mood:
+        for rule in rules:
+            if (all(stats[s] < t for s, t in rule.get("below", {}).items())
+                    and all(stats[s] > t for s, t in rule.get("above", {}).items())):
+                return Mood(rule["mood"])
+        return Mood.NORMAL
+    
+    def _index(self, satiation: float, energy: float, happiness: float) -> int:
+        index = 0
+        for cuts, size, value in zip(self._cut_lists, self._sizes, (satiation, energy, happiness)):
+            index = index * size + bisect.bisect_left(cuts, value) + bisect.bisect_right(cuts, value)
+        return index
+    
+    def mood(self, satiation: float, energy: float, happiness: float) -> Mood:
+        return self.table[self._index(satiation, energy, happiness)]
+    
+    def mood_indices(self, satiation, energy, happiness) -> List[int]:
+        """Moods for many states at once, as indices into list(Mood)
+        
+        Takes equal-length sequences of stats; with NumPy the lookup is
+        vectorized and a NumPy array is returned.
+        """
+        if HAS_NUMPY:
+            index = np.zeros(len(satiation), dtype=np.intp)
+            for cuts, size, values in zip(self._cut_lists, self._sizes,
+                                          (satiation, energy, happiness)):
+                values = np.asarray(values, dtype=np.float64)
+                index = index * size + (np.searchsorted(cuts, values, "left")
+                                        + np.searchsorted(cuts, values, "right"))
+            return self._index_array[index]
+        return [self.index_table[self._index(s, e, h)] for s, e, h in zip(satiation, energy, happiness)]
+
 class PetState:
     """Pet state management class"""
-    def __init__(self, data_file: str = "pet_data.json"):
+    def __init__(self, data_file: Optional[str] = "pet_data.json",
+                 rules: Optional[MoodRules] = None):
         self.data_file = data_file
+        self.rules = rules or MoodRules.default()
         self.satiation: float = 60.0
         self.energy: float = 80.0
         self.happiness: float = 70.0
         self.mood: Mood = Mood.NORMAL
         self.action: Optional[str] = None
-        self.action_timer: int = 0
         
         self.load_data()
     
     def load_data(self):
         try:
-            if os.path.exists(self.data_file):
+            if self.data_file and os.path.exists(self.data_file):
                 with open(self.data_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
                     self.satiation = self._clamp(data.get("satiation", 60))
@@ -559,6 +937,8 @@ class PetState:
             print(f"Data load failed: {e}")
     
     def save_data(self):
+        if not self.data_file:
+            return
         try:
             data = {
                 "satiation": self.satiation,
@@ -571,65 +951,1588 @@ class PetState:
         except Exception as e:
             print(f"Data save failed: {e}")
     
+    def to_dict(self) -> dict:
+        return {
+            "satiation": self.satiation,
+            "energy": self.energy,
+            "happiness": self.happiness,
+            "mood": self.mood.value,
+            "action": self.action,
+        }
+    
+    def load_dict(self, data: dict):
+        self.satiation = self._clamp(data.get("satiation", self.satiation))
+        self.energy = self._clamp(data.get("energy", self.energy))
+        self.happiness = self._clamp(data.get("happiness", self.happiness))
+        self.mood = Mood(data.get("mood", self.mood.value))
+        self.action = data.get("action", self.action)
+    
     @staticmethod
     def _clamp(value: float, min_val: float = 0, max_val: float = 100) -> float:
         return max(min_val, min(max_val, value))
     
-    def update(self):
-        self.satiation = max(0, self.satiation - Constants.SATIATION_DECAY_RATE)
-        self.energy = max(0, self.energy - Constants.ENERGY_DECAY_RATE)
+    def update(self, ticks: int = 1):
+        """Advance state by a number of nominal animation ticks"""
+        self.satiation = max(0, self.satiation - Constants.SATIATION_DECAY_RATE * ticks)
+        self.energy = max(0, self.energy - Constants.ENERGY_DECAY_RATE * ticks)
         
         if self.satiation < Constants.HUNGER_THRESHOLD_MEDIUM:
-            self.happiness = max(0, self.happiness - Constants.HAPPINESS_DECAY_HUNGRY)
+            self.happiness = max(0, self.happiness - Constants.HAPPINESS_DECAY_HUNGRY * ticks)
         if self.energy < Constants.ENERGY_THRESHOLD_LOW:
-            self.happiness = max(0, self.happiness - Constants.HAPPINESS_DECAY_TIRED)
+            self.happiness = max(0, self.happiness - Constants.HAPPINESS_DECAY_TIRED * ticks)
         
         self._update_mood()
+    
+    def ticks_until_change(self) -> float:
+        """Nominal ticks until a stat crosses a mood or decay threshold"""
+        candidates = []
+        
+        def until(value: float, rate: float, thresholds: tuple):
+            for threshold in thresholds:
+                if rate > 0 and value > threshold:
+                    candidates.append((value - threshold) / rate)
+        
+        cuts = self.rules.cuts
+        until(self.satiation, Constants.SATIATION_DECAY_RATE,
+              cuts["satiation"] + [Constants.HUNGER_THRESHOLD_MEDIUM])
+        until(self.energy, Constants.ENERGY_DECAY_RATE,
+              cuts["energy"] + [Constants.ENERGY_THRESHOLD_LOW])
+        
+        happiness_rate = 0.0
+        if self.satiation < Constants.HUNGER_THRESHOLD_MEDIUM:
+            happiness_rate += Constants.HAPPINESS_DECAY_HUNGRY
+        if self.energy < Constants.ENERGY_THRESHOLD_LOW:
+            happiness_rate += Constants.HAPPINESS_DECAY_TIRED
+        until(self.happiness, happiness_rate, cuts["happiness"])
         
-        if self.action_timer > 0:
-            self.action_timer -= 1
-        else:
-            self.action = None
+        return max(1, math.ceil(min(candidates))) if candidates else math.inf
     
     def _update_mood(self):
-        if self.energy < Constants.ENERGY_THRESHOLD_LOW:
-            self.mood = Mood.NORMAL
-        elif self.satiation < Constants.HUNGER_THRESHOLD_LOW:
-            self.mood = Mood.UPSET
-        elif self.satiation < Constants.HUNGER_THRESHOLD_MEDIUM:
-            self.mood = Mood.ANGRY
-        elif self.happiness > Constants.HAPPINESS_THRESHOLD_VERY_HIGH:
-            self.mood = Mood.LOVE
-        elif self.happiness > Constants.HAPPINESS_THRESHOLD_HIGH:
-            self.mood = Mood.HAPPY
-        elif self.happiness < Constants.HAPPINESS_THRESHOLD_LOW:
-            self.mood = Mood.MOST_ANGRY
+        self.mood = self.rules.mood(self.satiation, self.energy, self.happiness)
+    
+    def apply_action(self, name: str, satiation_gain: float = 0, happiness_gain: float = 0):
+        """Apply the configured effect of an action plus any item gains"""
+        satiation, energy, happiness, mood = self.rules.effects[name]
+        self.satiation = self._clamp(self.satiation + satiation + satiation_gain)
+        self.energy = self._clamp(self.energy + energy)
+        self.happiness = self._clamp(self.happiness + happiness + happiness_gain)
+        if mood is None:
+            self._update_mood()
+        else:
+            self.mood = mood
+    
+    def feed(self, satiation_gain: int) -> None:
+        self.apply_action("feed", satiation_gain=satiation_gain)
+    
+    def play(self, happiness_gain: int) -> None:
+        self.apply_action("play", happiness_gain=happiness_gain)
+    
+    def sleep(self) -> None:
+        self.apply_action("sleep")
+
+class StatsRing:
+    """Fixed-capacity ring buffer of stat samples backed by typed arrays"""
+    FIELDS = ("satiation", "energy", "happiness")
+    
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.stats = {name: array('f', [0.0]) * capacity for name in self.FIELDS}
+        self.moods = array('b', [0]) * capacity
+        self.start = 0
+        self.count = 0
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def append(self, timestamp: float, values: Tuple[float, float, float], mood_index: int):
+        if self.count < self.capacity:
+            i = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[i] = timestamp
+        for name, value in zip(self.FIELDS, values):
+            self.stats[name][i] = value
+        self.moods[i] = mood_index
+    
+    def _ordered(self, data: array) -> array:
+        end = self.start + self.count
+        if end <= self.capacity:
+            return data[self.start:end]
+        return data[self.start:] + data[:end - self.capacity]
+    
+    def series(self) -> dict:
+        """Samples in chronological order"""
+        result = {name: self._ordered(data) for name, data in self.stats.items()}
+        result["times"] = self._ordered(self.times)
+        result["moods"] = self._ordered(self.moods)
+        return result
+    
+    def to_dict(self) -> dict:
+        def encode(data: array) -> str:
+            return base64.b64encode(data.tobytes()).decode('ascii')
+        return {key: encode(data) for key, data in self.series().items()}
+    
+    def load_dict(self, data: dict):
+        def decode(typecode: str, text: str) -> array:
+            values = array(typecode)
+            values.frombytes(base64.b64decode(text))
+            return values
+        times = decode('d', data["times"])
+        stats = [decode('f', data[name]) for name in self.FIELDS]
+        moods = decode('b', data["moods"])
+        for i in range(max(0, len(times) - self.capacity), len(times)):
+            self.append(times[i], tuple(values[i] for values in stats), moods[i])
+
+class StatsRollup:
+    """Averages samples into fixed-period buckets kept in a StatsRing"""
+    def __init__(self, period: int, capacity: int):
+        self.period = period
+        self.ring = StatsRing(capacity)
+        self._bucket: Optional[float] = None
+        self._count = 0
+        self._sums = [0.0, 0.0, 0.0]
+        self._mood_counts = [0] * len(Mood)
+    
+    def add(self, timestamp: float, values: Tuple[float, float, float], mood_index: int):
+        bucket = timestamp - timestamp % self.period
+        if self._bucket is not None and bucket != self._bucket:
+            self.flush()
+        self._bucket = bucket
+        self._count += 1
+        for i, value in enumerate(values):
+            self._sums[i] += value
+        self._mood_counts[mood_index] += 1
+    
+    def flush(self):
+        if not self._count:
+            return
+        means = tuple(total / self._count for total in self._sums)
+        mood_index = max(range(len(self._mood_counts)), key=self._mood_counts.__getitem__)
+        self.ring.append(self._bucket, means, mood_index)
+        self._count = 0
+        self._sums = [0.0, 0.0, 0.0]
+        self._mood_counts = [0] * len(Mood)
+    
+    def to_dict(self) -> dict:
+        return {
+            "period": self.period,
+            "ring": self.ring.to_dict(),
+            "pending": [self._bucket, self._count, self._sums, self._mood_counts],
+        }
+    
+    def load_dict(self, data: dict):
+        self.ring.load_dict(data["ring"])
+        bucket, count, sums, mood_counts = data["pending"]
+        if len(mood_counts) == len(Mood):
+            self._bucket, self._count = bucket, count
+            self._sums, self._mood_counts = list(sums), list(mood_counts)
+
+class StatsHistory:
+    """Stat history: a raw sample ring plus per-minute/hour/day rollups
+    
+    Only the rollups are persisted, as base64-packed arrays.
+    """
+    def __init__(self, history_file: str = "pet_history.json"):
+        self.history_file = history_file
+        self.raw = StatsRing(Constants.HISTORY_RAW_CAPACITY)
+        self.rollups: Dict[str, StatsRollup] = {
+            name: StatsRollup(period, capacity)
+            for name, period, capacity in Constants.HISTORY_LEVELS
+        }
+        self.load_data()
+    
+    def record(self, state: PetState, timestamp: Optional[float] = None):
+        if timestamp is None:
+            timestamp = time.time()
+        values = (state.satiation, state.energy, state.happiness)
+        mood_index = list(Mood).index(state.mood)
+        self.raw.append(timestamp, values, mood_index)
+        for rollup in self.rollups.values():
+            rollup.add(timestamp, values, mood_index)
+    
+    def series(self, level: str) -> dict:
+        return self.rollups[level].ring.series()
+    
+    def load_data(self):
+        try:
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                for name, rollup_data in data.get("rollups", {}).items():
+                    rollup = self.rollups.get(name)
+                    if rollup and rollup_data.get("period") == rollup.period:
+                        rollup.load_dict(rollup_data)
+                print("History loaded successfully")
+        except Exception as e:
+            print(f"History load failed: {e}")
+    
+    def save_data(self):
+        try:
+            data = {
+                "version": 1,
+                "rollups": {name: rollup.to_dict() for name, rollup in self.rollups.items()}
+            }
+            with open(self.history_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+        except Exception as e:
+            print(f"History save failed: {e}")
+
+class HistoryWindow:
+    """Stats history chart window"""
+    WIDTH = 420
+    HEIGHT = 240
+    PADDING = 30
+    
+    def __init__(self, parent, history: StatsHistory, level: str = "minute"):
+        self.parent = parent
+        self.history = history
+        self.level = level
+        
+        self.window = tk.Toplevel(parent)
+        self.window.title("Stats History")
+        self.window.configure(bg=Constants.HISTORY_BG)
+        self.window.resizable(False, False)
+        self.window.attributes('-topmost', True)
+        
+        self._create_ui()
+        self.draw_chart()
+    
+    def _create_ui(self):
+        button_frame = tk.Frame(self.window, bg=Constants.HISTORY_BG)
+        button_frame.pack(pady=5)
+        for name, _, _ in Constants.HISTORY_LEVELS:
+            tk.Button(
+                button_frame,
+                text=f"Per {name}",
+                command=lambda n=name: self.set_level(n),
+                font=("Helvetica", 10),
+                relief=tk.FLAT
+            ).pack(side=tk.LEFT, padx=3)
+        
+        self.canvas = tk.Canvas(
+            self.window,
+            width=self.WIDTH,
+            height=self.HEIGHT,
+            bg=Constants.HISTORY_BG,
+            highlightthickness=0
+        )
+        self.canvas.pack(padx=10)
+        
+        legend = tk.Frame(self.window, bg=Constants.HISTORY_BG)
+        legend.pack(pady=5)
+        for label, color in (("Hunger", Constants.HISTORY_SATIATION),
+                             ("Energy", Constants.HISTORY_ENERGY),
+                             ("Happy", Constants.HISTORY_HAPPINESS)):
+            tk.Label(
+                legend, text=f"━ {label}", fg=color,
+                bg=Constants.HISTORY_BG, font=("Helvetica", 10, "bold")
+            ).pack(side=tk.LEFT, padx=6)
+    
+    def set_level(self, level: str):
+        self.level = level
+        self.draw_chart()
+    
+    def draw_chart(self):
+        """Draw one polyline per stat straight from the rollup arrays"""
+        self.canvas.delete("all")
+        pad = self.PADDING
+        width = self.WIDTH - 2 * pad
+        height = self.HEIGHT - 2 * pad
+        
+        for value in (0, 25, 50, 75, 100):
+            y = pad + height - value / 100 * height
+            self.canvas.create_line(pad, y, pad + width, y, fill=Constants.HISTORY_GRID)
+            self.canvas.create_text(pad - 5, y, text=str(value), anchor="e",
+                                    font=("Helvetica", 8), fill=Constants.STATUS_TEXT_COLOR)
+        
+        series = self.history.series(self.level)
+        times = series["times"]
+        if len(times) < 2:
+            self.canvas.create_text(
+                self.WIDTH // 2, self.HEIGHT // 2,
+                text="Not enough history yet",
+                font=("Helvetica", 11), fill=Constants.STATUS_TEXT_COLOR
+            )
+            return
+        
+        t0 = times[0]
+        span = (times[-1] - t0) or 1
+        xs = [pad + (t - t0) / span * width for t in times]
+        for name, color in (("satiation", Constants.HISTORY_SATIATION),
+                            ("energy", Constants.HISTORY_ENERGY),
+                            ("happiness", Constants.HISTORY_HAPPINESS)):
+            coords = []
+            for x, value in zip(xs, series[name]):
+                coords.extend((x, pad + height - value / 100 * height))
+            self.canvas.create_line(*coords, fill=color, width=2)
+        
+        fmt = '%H:%M' if self.level == "minute" else '%m-%d %H:%M' if self.level == "hour" else '%Y-%m-%d'
+        self.canvas.create_text(pad, self.HEIGHT - 10, anchor="w", font=("Helvetica", 8),
+                                text=datetime.fromtimestamp(t0).strftime(fmt),
+                                fill=Constants.STATUS_TEXT_COLOR)
+        self.canvas.create_text(pad + width, self.HEIGHT - 10, anchor="e", font=("Helvetica", 8),
+                                text=datetime.fromtimestamp(times[-1]).strftime(fmt),
+                                fill=Constants.STATUS_TEXT_COLOR)
+
+class WanderMode(Enum):
+    """Autonomous movement modes"""
+    IDLE = "idle"
+    WALK = "walk"
+    PERCH = "perch"
+
+class WanderEngine:
+    """Plans autonomous movement segments driven by pet state
+    
+    Positions are interpolated from monotonic time, so a late frame just
+    lands further along the segment and each frame costs the same.
+    """
+    def __init__(self, screen_width: int, screen_height: int,
+                 window_width: int, window_height: int,
+                 rng: Optional[random.Random] = None):
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.window_width = window_width
+        self.window_height = window_height
+        self.rng = rng or random.Random()
+        self.mode = WanderMode.IDLE
+        self._perched = False
+        self._start = (0.0, 0.0)
+        self._end = (0.0, 0.0)
+        self._t0 = 0.0
+        self._t1 = 0.0
+    
+    def set_window_size(self, width: int, height: int):
+        self.window_width = width
+        self.window_height = height
+    
+    @property
+    def max_x(self) -> float:
+        return max(0, self.screen_width - self.window_width)
+    
+    @property
+    def max_y(self) -> float:
+        return max(0, self.screen_height - self.window_height)
+    
+    def start(self, x: float, y: float, now: float):
+        """(Re)start from a known position, idling briefly first"""
+        self.mode = WanderMode.IDLE
+        self._start = self._end = (x, y)
+        self._t0 = now
+        self._t1 = now + self.rng.uniform(*Constants.WANDER_IDLE_TIME)
+    
+    @property
+    def moving(self) -> bool:
+        return self._start != self._end
+    
+    @property
+    def segment_end(self) -> float:
+        return self._t1
+    
+    def _speed(self, state: PetState) -> float:
+        factor = max(Constants.WANDER_MIN_SPEED_FACTOR, state.energy / 100)
+        if state.mood in (Mood.HAPPY, Mood.LOVE, Mood.EXCITED):
+            factor *= 1.5
+        return Constants.WANDER_SPEED * factor
+    
+    def _walk_to(self, x: float, y: float, state: PetState, now: float, mode: WanderMode):
+        x = max(0.0, min(self.max_x, x))
+        y = max(0.0, min(self.max_y, y))
+        self._start = self._end
+        self._end = (x, y)
+        distance = math.hypot(x - self._start[0], y - self._start[1])
+        self.mode = mode
+        self._t0 = now
+        self._t1 = now + distance / self._speed(state)
+    
+    def _rest(self, now: float, duration: Tuple[float, float], mode: WanderMode):
+        self._start = self._end
+        self.mode = mode
+        self._t0 = now
+        self._t1 = now + self.rng.uniform(*duration)
+    
+    def _plan(self, state: PetState, now: float):
+        x, y = self._end
+        if self.mode == WanderMode.WALK:
+            self._rest(now, Constants.WANDER_IDLE_TIME, WanderMode.IDLE)
+        elif self.mode == WanderMode.PERCH and not self._perched:
+            # Arrived at an edge: sit there for a while
+            self._perched = True
+            self._rest(now, Constants.WANDER_PERCH_TIME, WanderMode.PERCH)
+        elif (state.energy < Constants.ENERGY_THRESHOLD_LOW
+              or self.rng.random() < Constants.WANDER_PERCH_CHANCE):
+            # Tired or bored: head for the nearest screen edge and perch
+            edges = [
+                (0.0, y, x),
+                (self.max_x, y, self.max_x - x),
+                (x, self.max_y, self.max_y - y),
+            ]
+            ex, ey, _ = min(edges, key=lambda e: e[2])
+            self._perched = False
+            self._walk_to(ex, ey, state, now, WanderMode.PERCH)
+        elif self.rng.random() < 0.3 + 0.5 * state.energy / 100:
+            self._walk_to(self.rng.uniform(0, self.max_x), y, state, now, WanderMode.WALK)
+        else:
+            self._rest(now, Constants.WANDER_IDLE_TIME, WanderMode.IDLE)
+    
+    def position(self, state: PetState, now: float) -> Tuple[float, float]:
+        """Window position at monotonic time now"""
+        if now >= self._t1:
+            self._plan(state, now)
+        if self._t1 <= self._t0:
+            return self._end
+        progress = min(1.0, max(0.0, (now - self._t0) / (self._t1 - self._t0)))
+        return (
+            self._start[0] + (self._end[0] - self._start[0]) * progress,
+            self._start[1] + (self._end[1] - self._start[1]) * progress,
+        )
+
+class FrameStore:
+    """Content-addressed frame store that shares identical frames
+    
+    Frames are kept zlib-compressed while they are not displayed and are
+    only expanded again when a new display size is built.
+    """
+    def __init__(self):
+        self._frames: Dict[str, Tuple[str, Tuple[int, int], bytes]] = {}
+        self.total_frames = 0
+        self.raw_bytes = 0
+    
+    @staticmethod
+    def digest(image: Image.Image, data: Optional[bytes] = None) -> str:
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(f"{image.mode}{image.size}".encode())
+        hasher.update(data if data is not None else image.tobytes())
+        return hasher.hexdigest()
+    
+    def add(self, image: Image.Image) -> str:
+        data = image.tobytes()
+        key = self.digest(image, data)
+        self.total_frames += 1
+        self.raw_bytes += len(data)
+        if key not in self._frames:
+            self._frames[key] = (image.mode, image.size, zlib.compress(data, 1))
+        return key
+    
+    def get(self, key: str) -> Image.Image:
+        mode, size, data = self._frames[key]
+        return Image.frombytes(mode, size, zlib.decompress(data))
+    
+    def discard(self, key: str):
+        self._frames.pop(key, None)
+    
+    def load_gif(self, filepath: str) -> List[str]:
+        """Decode every frame of a GIF into the store, return the frame keys"""
+        gif = Image.open(filepath)
+        keys = []
+        
+        i = 0
+        while True:
+            try:
+                gif.seek(i)
+                keys.append(self.add(gif.convert("RGBA")))
+                i += 1
+            except EOFError:
+                break
+        return keys
+    
+    def resize_all(self, keys, size: int, resample) -> Dict[str, Image.Image]:
+        """Resize each unique frame once; identical results share one image"""
+        unique: Dict[str, Image.Image] = {}
+        resized_by_key: Dict[str, Image.Image] = {}
+        for key in keys:
+            if key not in resized_by_key:
+                frame = self.get(key).resize((size, size), resample)
+                resized_by_key[key] = unique.setdefault(self.digest(frame), frame)
+        return resized_by_key
+    
+    @property
+    def unique_frames(self) -> int:
+        return len(self._frames)
+    
+    @property
+    def stored_bytes(self) -> int:
+        return sum(len(data) for _, _, data in self._frames.values())
+    
+    @property
+    def bytes_saved(self) -> int:
+        return self.raw_bytes - self.stored_bytes
+
+class SpriteAtlas:
+    """Sprite sheet packing same-sized frames into a single Tk image"""
+    def __init__(self, frames: Dict[str, Image.Image], frame_size: int):
+        # Frames are keyed by store digest, so shared frames are packed once
+        self.frame_size = frame_size
+        total = len(frames)
+        self.columns = max(1, math.ceil(math.sqrt(total)))
+        rows = max(1, math.ceil(total / self.columns))
+        
+        sheet = Image.new("RGBA", (self.columns * frame_size, rows * frame_size), (0, 0, 0, 0))
+        self.slots: Dict[str, Tuple[int, int]] = {}
+        for slot, (key, frame) in enumerate(frames.items()):
+            x = (slot % self.columns) * frame_size
+            y = (slot // self.columns) * frame_size
+            sheet.paste(frame, (x, y))
+            self.slots[key] = (x, y)
+        
+        self.photo = ImageTk.PhotoImage(sheet)
+    
+    def locations(self) -> Dict[str, Tuple[str, int, int]]:
+        """Frame locations as (Tk image name, x, y) per digest"""
+        name = str(self.photo)
+        return {key: (name, x, y) for key, (x, y) in self.slots.items()}
+
+class WeatherTint:
+    """Affine color transforms for weather and time-of-day frame variants
+    
+    Each transform is a 3x4 matrix (RGB rows plus offset) in the 12-tuple
+    layout PIL's convert() accepts, so NumPy and PIL give the same result.
+    """
+    MATRICES = {
+        "rain": (0.80, 0.05, 0.05, 0,
+                 0.05, 0.85, 0.05, 0,
+                 0.05, 0.10, 0.95, 15),
+        "snow": (0.80, 0.10, 0.10, 25,
+                 0.10, 0.80, 0.10, 25,
+                 0.10, 0.10, 0.85, 40),
+        "fog": (0.55, 0.25, 0.10, 35,
+                0.20, 0.60, 0.10, 35,
+                0.20, 0.25, 0.45, 35),
+        "storm": (0.60, 0.05, 0.05, 0,
+                  0.05, 0.60, 0.05, 0,
+                  0.10, 0.10, 0.80, 10),
+        "night": (0.55, 0.05, 0.10, 0,
+                  0.05, 0.60, 0.10, 0,
+                  0.10, 0.15, 0.85, 20),
+    }
+    WEATHER_CODES = {
+        "fog": (45, 48),
+        "rain": (51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82),
+        "snow": (71, 73, 75, 77, 85, 86),
+        "storm": (95, 96, 99),
+    }
+    
+    @classmethod
+    def condition(cls, weather_data: Optional[dict]) -> str:
+        """Condition key such as clear, rain or snow_night"""
+        if not weather_data:
+            return "clear"
+        code = weather_data.get('weather_code', 0)
+        parts = [name for name, codes in cls.WEATHER_CODES.items() if code in codes]
+        if not weather_data.get('is_day', True):
+            parts.append("night")
+        return "_".join(parts) or "clear"
+    
+    @staticmethod
+    def _compose(outer: tuple, inner: tuple) -> tuple:
+        """Matrix applying inner first, then outer"""
+        result = []
+        for row in range(3):
+            o = outer[row * 4:row * 4 + 4]
+            for col in range(3):
+                result.append(sum(o[k] * inner[k * 4 + col] for k in range(3)))
+            result.append(sum(o[k] * inner[k * 4 + 3] for k in range(3)) + o[3])
+        return tuple(result)
+    
+    @classmethod
+    def matrix(cls, condition: str) -> Optional[tuple]:
+        matrix = None
+        for part in condition.split("_"):
+            step = cls.MATRICES.get(part)
+            if step:
+                matrix = step if matrix is None else cls._compose(step, matrix)
+        return matrix
+    
+    @staticmethod
+    def apply_all(images: List[Image.Image], matrix: tuple) -> List[Image.Image]:
+        """Transform same-sized RGBA frames, in one vectorized pass with NumPy"""
+        if not images:
+            return []
+        if HAS_NUMPY:
+            pixels = np.stack([np.asarray(image) for image in images]).astype(np.float32)
+            m = np.asarray(matrix, dtype=np.float32).reshape(3, 4)
+            pixels[..., :3] = pixels[..., :3] @ m[:, :3].T + m[:, 3]
+            np.clip(pixels, 0, 255, out=pixels)
+            out = pixels.astype(np.uint8)
+            return [Image.fromarray(frame, "RGBA") for frame in out]
+        
+        result = []
+        for image in images:
+            tinted = image.convert("RGB").convert("RGB", matrix)
+            tinted.putalpha(image.getchannel("A"))
+            result.append(tinted)
+        return result
+
+class FrameSet:
+    """Display-ready frames for one pet size
+    
+    The Tk images are the only expanded copies kept. The PIL frames stay
+    zlib-compressed in a per-size FrameStore, where identical frames share
+    one entry and one Tk image, also after high quality swaps.
+    """
+    def __init__(self, size: int, source_frames: Dict[str, List[str]],
+                 resized_by_source: Dict[str, Image.Image], atlas_mode: str = "off",
+                 high_quality: bool = True):
+        self.size = size
+        self.high_quality = high_quality
+        self.source_frames = source_frames
+        self.store = FrameStore()
+        self.frame_keys = {key: self.store.add(frame) for key, frame in resized_by_source.items()}
+        unique = {digest: resized_by_source[key] for key, digest in self.frame_keys.items()}
+        # Per digest: a PhotoImage, or an (image name, x, y) location in atlas mode
+        self.photos: Dict[str, ImageTk.PhotoImage] = {}
+        self.atlas_slots: Dict[str, Tuple[str, int, int]] = {}
+        self.atlases: List[SpriteAtlas] = []
+        self.display_image: Optional[tk.PhotoImage] = None
+        self._shown_atlas_frame: Optional[Tuple[str, int, int]] = None
+        self._decoded: Optional[Tuple[str, Image.Image]] = None
+        
+        if atlas_mode in ("mood", "skin") and unique:
+            # One sheet per mood or one for the whole skin, plus a single
+            # display image that the current frame is copied into
+            if atlas_mode == "skin":
+                groups = [unique]
+            else:
+                groups = [
+                    {self.frame_keys[key]: unique[self.frame_keys[key]] for key in keys}
+                    for keys in source_frames.values()
+                ]
+            for group in groups:
+                atlas = SpriteAtlas(group, size)
+                self.atlases.append(atlas)
+                for digest, location in atlas.locations().items():
+                    self.atlas_slots.setdefault(digest, location)
+            self.display_image = tk.PhotoImage(width=size, height=size)
+            print(f"Sprite atlas: {len(self.atlases) + 1} Tk images for {len(unique)} unique frames")
+        else:
+            self.photos = {digest: ImageTk.PhotoImage(frame) for digest, frame in unique.items()}
+    
+    def is_empty(self) -> bool:
+        return not self.frame_keys
+    
+    def frames(self) -> Dict[str, Image.Image]:
+        """Each unique frame decoded, by digest"""
+        return {digest: self.store.get(digest) for digest in dict.fromkeys(self.frame_keys.values())}
+    
+    def replace(self, source_key: str, image: Image.Image):
+        """Swap one frame, e.g. with a higher quality resample"""
+        old = self.frame_keys.get(source_key)
+        if old is None:
+            return
+        new = self.store.add(image)
+        if new == old:
+            return
+        self.frame_keys[source_key] = new
+        old_in_use = old in self.frame_keys.values()
+        
+        if new in self.photos or new in self.atlas_slots:
+            pass  # Identical to a frame already shown; share it
+        elif old_in_use:
+            # Other frames still show the old image, so this one gets its own
+            photo = ImageTk.PhotoImage(image)
+            self.photos[new] = photo
+            if self.atlases:
+                self.atlas_slots[new] = (str(photo), 0, 0)
+        elif old in self.photos:
+            photo = self.photos.pop(old)
+            photo.paste(image)
+            self.photos[new] = photo
+            if self.atlases:
+                self.atlas_slots[new] = self.atlas_slots.pop(old)
+        else:
+            patch = ImageTk.PhotoImage(image)
+            for atlas in self.atlases:
+                if old in atlas.slots:
+                    x, y = atlas.slots[new] = atlas.slots.pop(old)
+                    atlas.photo.tk.call(
+                        str(atlas.photo), 'copy', str(patch),
+                        '-to', x, y,
+                        '-compositingrule', 'set'
+                    )
+            self.atlas_slots[new] = self.atlas_slots.pop(old)
+        
+        if not old_in_use:
+            self.store.discard(old)
+            self.photos.pop(old, None)
+            self.atlas_slots.pop(old, None)
+        self._shown_atlas_frame = None
+    
+    def _keys(self, mood_key: str) -> List[str]:
+        return self.source_frames.get(mood_key, self.source_frames.get("normal", []))
+    
+    def _digest(self, mood_key: str, animation_frame: int) -> Optional[str]:
+        keys = self._keys(mood_key)
+        if not keys:
+            return None
+        return self.frame_keys[keys[(animation_frame // Constants.FRAME_SPEED) % len(keys)]]
+    
+    def frame_count(self, mood_key: str) -> int:
+        return len(self._keys(mood_key))
+    
+    def pil_frame(self, mood_key: str, animation_frame: int) -> Optional[Image.Image]:
+        digest = self._digest(mood_key, animation_frame)
+        if digest is None:
+            return None
+        if not self._decoded or self._decoded[0] != digest:
+            self._decoded = (digest, self.store.get(digest))
+        return self._decoded[1]
+    
+    def current_image(self, mood_key: str, animation_frame: int):
+        digest = self._digest(mood_key, animation_frame)
+        if digest is None:
+            return None
+        if not self.atlases:
+            return self.photos[digest]
+        
+        frame = self.atlas_slots[digest]
+        if frame != self._shown_atlas_frame:
+            sheet, x, y = frame
+            self.display_image.tk.call(
+                self.display_image, 'copy', sheet,
+                '-from', x, y, x + self.size, y + self.size,
+                '-to', 0, 0,
+                '-compositingrule', 'set'
+            )
+            self._shown_atlas_frame = frame
+        return self.display_image
+
+class IpcClient:
+    """One connected control API client"""
+    __slots__ = ("sock", "fd", "inbuf", "outbuf", "subscribed", "eof")
+    
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.subscribed = False
+        # Peer closed its write side; close once the replies are sent
+        self.eof = False
+
+class IpcServer:
+    """JSON-lines control API on a Unix domain socket
+    
+    Sockets are non-blocking and served from the Tk event loop through
+    file handlers, falling back to a zero-timeout select() poll where Tk
+    has no file handler support.
+    """
+    def __init__(self, pet: "DesktopPet", path: str):
+        self.pet = pet
+        self.path = path
+        self.server: Optional[socket.socket] = None
+        self.clients: Dict[int, IpcClient] = {}
+        self._use_file_handlers = True
+        self._poll_after: Optional[str] = None
+        self._last_snapshot: Optional[dict] = None
+        self.commands = {
+            "ping": lambda request: "pong",
+            "state": lambda request: self.snapshot(),
+            "feed": self._cmd_feed,
+            "play": self._cmd_play,
+            "sleep": self._cmd_sleep,
+            "speak": self._cmd_speak,
+            "subscribe": self._cmd_subscribe,
+            "unsubscribe": self._cmd_unsubscribe,
+        }
+    
+    def start(self) -> bool:
+        if not hasattr(socket, "AF_UNIX"):
+            print("Control API unavailable: no Unix domain sockets")
+            return False
+        if not self._remove_stale_socket():
+            return False
+        try:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.path)
+            os.chmod(self.path, 0o600)
+            self.server.listen(64)
+            self.server.setblocking(False)
+        except OSError as e:
+            print(f"Control API start failed: {e}")
+            self.server = None
+            return False
+        
+        try:
+            self._watch(self.server, tk.READABLE, self._on_accept)
+        except (AttributeError, tk.TclError):
+            self._use_file_handlers = False
+            self._poll()
+        print(f"Control API listening on {self.path}")
+        return True
+    
+    def _remove_stale_socket(self) -> bool:
+        """Clear a socket left by a crashed pet; never touch anything else"""
+        try:
+            mode = os.lstat(self.path).st_mode
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            print(f"Control API start failed: {e}")
+            return False
+        if not S_ISSOCK(mode):
+            print(f"Control API not started: {self.path} exists and is not a socket")
+            return False
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(0.5)
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            pass
+        except OSError as e:
+            print(f"Control API start failed: {e}")
+            return False
         else:
-            self.mood = Mood.NORMAL
-    
-    def feed(self, satiation_gain: int, energy_cost: int = 5, happiness_gain: int = 5) -> None:
-        self.satiation = self._clamp(self.satiation + satiation_gain)
-        self.energy = max(0, self.energy - energy_cost)
-        self.happiness = self._clamp(self.happiness + happiness_gain)
-        self.mood = Mood.HAPPY
-    
-    def play(self, happiness_gain: int, energy_cost: int = 20, satiation_cost: int = 10) -> None:
-        self.happiness = self._clamp(self.happiness + happiness_gain)
-        self.energy = max(0, self.energy - energy_cost)
-        self.satiation = max(0, self.satiation - satiation_cost)
-        self.mood = Mood.EXCITED
-    
-    def sleep(self, satiation_cost: int = 5, happiness_gain: int = 5) -> None:
-        self.energy = 100
-        self.satiation = max(0, self.satiation - satiation_cost)
-        self.happiness = self._clamp(self.happiness + happiness_gain)
-        self.mood = Mood.NORMAL
-
-class DesktopPet:
+            print(f"Control API not started: another pet is listening on {self.path}")
+            return False
+        finally:
+            probe.close()
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            print(f"Control API start failed: {e}")
+            return False
+        return True
+    
+    def stop(self):
+        for client in list(self.clients.values()):
+            self._close(client)
+        if self.server:
+            self._unwatch(self.server)
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._poll_after:
+            self.pet.window.after_cancel(self._poll_after)
+            self._poll_after = None
+    
+    # Event loop integration
+    
+    def _watch(self, sock: socket.socket, mask: int, callback):
+        if self._use_file_handlers:
+            self.pet.window.tk.createfilehandler(sock, mask, callback)
+    
+    def _unwatch(self, sock: socket.socket):
+        if self._use_file_handlers:
+            try:
+                self.pet.window.tk.deletefilehandler(sock)
+            except (ValueError, tk.TclError):
+                pass
+    
+    def _poll(self):
+        """Fallback: one non-blocking select over every socket"""
+        self._poll_after = None
+        if not self.server:
+            return
+        readers = [self.server] + [client.sock for client in self.clients.values() if not client.eof]
+        writers = [client.sock for client in self.clients.values() if client.outbuf]
+        try:
+            readable, writable, _ = select.select(readers, writers, [], 0)
+        except (OSError, ValueError):
+            readable, writable = [], []
+        for sock in readable:
+            if sock is self.server:
+                self._on_accept(sock, tk.READABLE)
+            else:
+                self._on_client(sock, tk.READABLE)
+        for sock in writable:
+            self._on_client(sock, tk.WRITABLE)
+        self._poll_after = self.pet.window.after(Constants.IPC_POLL_DELAY, self._poll)
+    
+    def _on_accept(self, sock, mask):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Control API accept failed: {e}")
+                return
+            conn.setblocking(False)
+            client = IpcClient(conn)
+            self.clients[client.fd] = client
+            self._watch(conn, tk.READABLE, self._on_client)
+    
+    def _on_client(self, sock, mask):
+        client = self.clients.get(sock.fileno())
+        if client is None:
+            return
+        if mask & tk.WRITABLE:
+            self._flush(client)
+        if mask & tk.READABLE and client.fd in self.clients:
+            self._read(client)
+    
+    def _read(self, client: IpcClient):
+        if client.eof:
+            return
+        eof = False
+        while True:
+            try:
+                chunk = client.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                chunk = b""
+            if not chunk:
+                eof = True
+                # A final request may come without its newline
+                if client.inbuf.strip() and len(client.inbuf) <= Constants.IPC_MAX_LINE:
+                    client.inbuf += b"\n"
+                break
+            client.inbuf += chunk
+        
+        # Requests sent just before a close still get handled
+        while b"\n" in client.inbuf:
+            line, _, rest = client.inbuf.partition(b"\n")
+            client.inbuf = bytearray(rest)
+            if line.strip():
+                self._handle(client, bytes(line))
+            if client.fd not in self.clients:
+                return
+        if len(client.inbuf) > Constants.IPC_MAX_LINE:
+            self._close(client)
+        elif eof:
+            client.eof = True
+            self._flush(client)
+    
+    def _flush(self, client: IpcClient):
+        try:
+            sent = client.sock.send(client.outbuf)
+            del client.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self._close(client)
+            return
+        if client.eof and not client.outbuf:
+            self._close(client)
+            return
+        mask = (0 if client.eof else tk.READABLE) | (tk.WRITABLE if client.outbuf else 0)
+        self._watch(client.sock, mask, self._on_client)
+    
+    def _send(self, client: IpcClient, message: dict):
+        client.outbuf += json.dumps(message, ensure_ascii=False).encode('utf-8') + b"\n"
+        if len(client.outbuf) > Constants.IPC_MAX_BUFFER:
+            # Client is not reading; drop it rather than grow without bound
+            self._close(client)
+            return
+        self._flush(client)
+    
+    def _close(self, client: IpcClient):
+        if self.clients.pop(client.fd, None) is None:
+            return
+        self._unwatch(client.sock)
+        try:
+            client.sock.close()
+        except OSError:
+            pass
+    
+    # Requests
+    
+    def _handle(self, client: IpcClient, line: bytes):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            request_id = request.get("id")
+            handler = self.commands.get(request.get("cmd"))
+            if handler is None:
+                raise ValueError(f"unknown command: {request.get('cmd')}")
+            if request.get("cmd") in ("subscribe", "unsubscribe"):
+                result = handler(request, client)
+            else:
+                result = handler(request)
+            self._send(client, {"id": request_id, "ok": True, "result": result})
+        except Exception as e:
+            self._send(client, {"id": request_id, "ok": False, "error": str(e)})
+    
+    def snapshot(self) -> dict:
+        state = self.pet.state
+        return {
+            "satiation": round(state.satiation, 1),
+            "energy": round(state.energy, 1),
+            "happiness": round(state.happiness, 1),
+            "mood": state.mood.value,
+            "action": state.action,
+            "speech": self.pet.speech_bubble,
+        }
+    
+    def _cmd_feed(self, request: dict):
+        food = request.get("food", "Rice")
+        gain = request.get("gain", self.pet.config.get("foods", {}).get(food))
+        if gain is None:
+            raise ValueError(f"unknown food: {food}")
+        self.pet.feed(food, int(gain))
+        return self.snapshot()
+    
+    def _cmd_play(self, request: dict):
+        play = request.get("play", "Chat")
+        gain = request.get("gain", self.pet.config.get("plays", {}).get(play))
+        if gain is None:
+            raise ValueError(f"unknown play: {play}")
+        self.pet.play_action(play, int(gain))
+        return self.snapshot()
+    
+    def _cmd_sleep(self, request: dict):
+        self.pet.sleep_action()
+        return self.snapshot()
+    
+    def _cmd_speak(self, request: dict):
+        duration = request.get("duration", 2.0)
+        if (not isinstance(duration, (int, float)) or isinstance(duration, bool)
+                or not math.isfinite(duration) or duration < 0):
+            raise ValueError("duration must be a finite, non-negative number")
+        self.pet.say(str(request["text"]), float(duration))
+        return self.snapshot()
+    
+    def _cmd_subscribe(self, request: dict, client: IpcClient):
+        client.subscribed = True
+        return self.snapshot()
+    
+    def _cmd_unsubscribe(self, request: dict, client: IpcClient):
+        client.subscribed = False
+        return None
+    
+    # Events
+    
+    def publish_state(self):
+        """Send a state event to subscribers when the visible state changed"""
+        subscribers = [client for client in self.clients.values() if client.subscribed]
+        if not subscribers:
+            self._last_snapshot = None
+            return
+        snapshot = self.snapshot()
+        # Compare at whole-number resolution to avoid an event every tick
+        key = {k: round(v) if isinstance(v, float) else v for k, v in snapshot.items()}
+        if key == self._last_snapshot:
+            return
+        self._last_snapshot = key
+        message = {"event": "state", "data": snapshot}
+        for client in subscribers:
+            self._send(client, message)
+
+class SpeechBubbleRenderer:
+    """Rasterizes speech bubbles once per (text, style) into an LRU cache
+    
+    The bubble matches the shape the canvas used to draw item by item:
+    a 90x32 oval with a tail, text wrapped at 80 px.
+    """
+    SCALE = 2
+    WIDTH = 94
+    HEIGHT = 46
+    # Oval center inside the bubble image
+    CENTER_X = 47
+    CENTER_Y = 18
+    # Loaded fonts by (names, pixel size), shared by all renderers
+    _fonts: Dict[tuple, object] = {}
+    
+    def __init__(self, capacity: int = Constants.BUBBLE_CACHE_SIZE):
+        self.capacity = capacity
+        self._cache: "OrderedDict[tuple, list]" = OrderedDict()
+        self.renders = 0
+    
+    @staticmethod
+    def default_style() -> tuple:
+        return (Constants.BUBBLE_BG, Constants.BUBBLE_OUTLINE,
+                Constants.BUBBLE_TEXT_COLOR, Constants.BUBBLE_FONT_SIZE)
+    
+    @classmethod
+    def load_font(cls, pixel_size: int, names: Tuple[str, ...] = Constants.BUBBLE_FONTS):
+        """First available font of names at pixel_size, cached per size"""
+        key = (names, pixel_size)
+        font = cls._fonts.get(key)
+        if font is None:
+            for name in names:
+                try:
+                    font = ImageFont.truetype(name, pixel_size)
+                    break
+                except OSError:
+                    continue
+            else:
+                try:
+                    # Scalable default font, Pillow 10.1 and later
+                    font = ImageFont.load_default(size=pixel_size)
+                except TypeError:
+                    font = ImageFont.load_default()
+            cls._fonts[key] = font
+        return font
+    
+    def _get_font(self, size: int):
+        return self.load_font(size * self.SCALE)
+    
+    def _wrap(self, draw, text: str, font, width: int) -> List[str]:
+        lines = []
+        for paragraph in text.split("\n"):
+            line = ""
+            for word in paragraph.split(" "):
+                candidate = f"{line} {word}" if line else word
+                if line and draw.textlength(candidate, font=font) > width:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = candidate
+            lines.append(line)
+        return lines
+    
+    def _render(self, text: str, style: tuple) -> Image.Image:
+        fill, outline, text_color, font_size = style
+        k = self.SCALE
+        image = Image.new("RGBA", (self.WIDTH * k, self.HEIGHT * k), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        cx, cy = self.CENTER_X * k, self.CENTER_Y * k
+        
+        draw.ellipse((cx - 45 * k, cy - 16 * k, cx + 45 * k, cy + 16 * k),
+                     fill=fill, outline=outline, width=2 * k)
+        draw.polygon([(cx - 25 * k, cy + 16 * k), (cx - 35 * k, cy + 27 * k),
+                      (cx - 15 * k, cy + 18 * k)],
+                     fill=fill, outline=outline)
+        
+        font = self._get_font(font_size)
+        lines = self._wrap(draw, text, font, 80 * k)
+        text = "\n".join(lines)
+        left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=font, align="center")
+        draw.multiline_text((cx - (left + right) / 2, cy - (top + bottom) / 2), text,
+                            font=font, fill=text_color, align="center")
+        
+        self.renders += 1
+        return image.resize((self.WIDTH, self.HEIGHT), Image.Resampling.LANCZOS)
+    
+    def _entry(self, text: str, style: Optional[tuple]) -> list:
+        key = (text, style or self.default_style())
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = [self._render(text, key[1]), None]
+            self._cache[key] = entry
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return entry
+    
+    def image(self, text: str, style: Optional[tuple] = None) -> Image.Image:
+        return self._entry(text, style)[0]
+    
+    def photo(self, text: str, style: Optional[tuple] = None) -> ImageTk.PhotoImage:
+        entry = self._entry(text, style)
+        if entry[1] is None:
+            entry[1] = ImageTk.PhotoImage(entry[0])
+        return entry[1]
+
+class TkRenderer:
+    """Draws the pet, bubble and status text into the Tk window"""
+    def __init__(self, pet: "DesktopPet"):
+        self.pet = pet
+        self._status_text: Optional[str] = None
+    
+    def render(self, mood_key: str, animation_frame: int,
+               speech: Optional[str], status_text: str):
+        pet = self.pet
+        pet.canvas.delete("all")
+        
+        image = pet.frame_set.current_image(mood_key, animation_frame)
+        if image:
+            pet.canvas.create_image(
+                pet.canvas_width // 2,
+                pet.canvas_height // 2,
+                image=image
+            )
+        
+        if speech:
+            bubble_x, bubble_y = pet.bubble_position()
+            pet.canvas.create_image(
+                bubble_x, bubble_y,
+                image=pet.bubbles.photo(speech),
+                anchor="nw"
+            )
+        
+        if status_text != self._status_text:
+            self._status_text = status_text
+            pet.status_label.config(text=status_text)
+
+class OffscreenRenderer:
+    """Composites pet, bubble and status layers into a PIL image
+    
+    Each layer is cached with the key it was drawn from; when a key
+    changes only the union of the old and new layer boxes is re-composited.
+    Works without a display, for tests, snapshots and documentation.
+    """
+    STATUS_HEIGHT = 80
+    
+    def __init__(self, pet_size: int, frame_source, bubbles: Optional[SpeechBubbleRenderer] = None,
+                 background: str = Constants.CANVAS_BG):
+        self.pet_size = pet_size
+        self.width = pet_size + 100
+        self.height = pet_size + self.STATUS_HEIGHT
+        self.frame_source = frame_source
+        self.bubbles = bubbles or SpeechBubbleRenderer()
+        self.background = Image.new("RGBA", (self.width, self.height), background)
+        self.image = self.background.copy()
+        # Layer name -> (key, image, (x, y)), drawn in this order
+        self.layers: Dict[str, Tuple[object, Optional[Image.Image], Tuple[int, int]]] = {
+            "pet": (None, None, (0, 0)),
+            "bubble": (None, None, (0, 0)),
+            "status": (None, None, (0, 0)),
+        }
+        self._font = SpeechBubbleRenderer.load_font(
+            Constants.STATUS_FONT_SIZE, Constants.STATUS_FONTS + Constants.BUBBLE_FONTS)
+        self.composited_pixels = 0
+        # Frames are written as they are captured, never buffered
+        self._capture_dir: Optional[str] = None
+        self._capture_prefix = "frame"
+        self.captured = 0
+    
+    def bubble_position(self) -> Tuple[int, int]:
+        return (self.width // 2 + 40 - SpeechBubbleRenderer.CENTER_X,
+                30 - SpeechBubbleRenderer.CENTER_Y)
+    
+    def _status_image(self, text: str) -> Image.Image:
+        image = Image.new("RGBA", (self.width, self.STATUS_HEIGHT), Constants.STATUS_BG)
+        draw = ImageDraw.Draw(image)
+        left, top, right, bottom = draw.multiline_textbbox((0, 0), text, font=self._font, align="center")
+        draw.multiline_text(((self.width - (left + right)) / 2, 5 - top), text,
+                            font=self._font, fill=Constants.STATUS_TEXT_COLOR, align="center")
+        return image
+    
+    @staticmethod
+    def _box(layer) -> Optional[Tuple[int, int, int, int]]:
+        _, image, (x, y) = layer
+        if image is None:
+            return None
+        return (x, y, x + image.width, y + image.height)
+    
+    def _set_layer(self, name: str, key, make_image, position: Tuple[int, int], dirty: list):
+        if self.layers[name][0] == key:
+            return
+        old_box = self._box(self.layers[name])
+        self.layers[name] = (key, make_image() if key is not None else None, position)
+        for box in (old_box, self._box(self.layers[name])):
+            if box:
+                dirty.append(box)
+    
+    def render(self, mood_key: str, animation_frame: int,
+               speech: Optional[str], status_text: str) -> Image.Image:
+        dirty: list = []
+        frame = self.frame_source(mood_key, animation_frame)
+        offset = ((self.width - self.pet_size) // 2, 0)
+        self._set_layer("pet", id(frame) if frame else None, lambda: frame, offset, dirty)
+        self._set_layer("bubble", speech, lambda: self.bubbles.image(speech),
+                        self.bubble_position(), dirty)
+        self._set_layer("status", status_text, lambda: self._status_image(status_text),
+                        (0, self.pet_size), dirty)
+        
+        if dirty:
+            box = (
+                max(0, min(b[0] for b in dirty)), max(0, min(b[1] for b in dirty)),
+                min(self.width, max(b[2] for b in dirty)), min(self.height, max(b[3] for b in dirty)),
+            )
+            region = self.background.crop(box)
+            for layer in self.layers.values():
+                layer_box = self._box(layer)
+                if not layer_box:
+                    continue
+                # Intersection of the layer with the dirty region
+                ix0, iy0 = max(box[0], layer_box[0]), max(box[1], layer_box[1])
+                ix1, iy1 = min(box[2], layer_box[2]), min(box[3], layer_box[3])
+                if ix0 >= ix1 or iy0 >= iy1:
+                    continue
+                _, image, (x, y) = layer
+                part = image.crop((ix0 - x, iy0 - y, ix1 - x, iy1 - y))
+                region.alpha_composite(part, (ix0 - box[0], iy0 - box[1]))
+            self.image.paste(region, box[:2])
+            self.composited_pixels += (box[2] - box[0]) * (box[3] - box[1])
+        
+        if self._capture_dir is not None and (dirty or not self.captured):
+            path = os.path.join(self._capture_dir, f"{self._capture_prefix}_{self.captured:05d}.png")
+            self.image.save(path, compress_level=1)
+            self.captured += 1
+        return self.image
+    
+    def start_capture(self, directory: str, prefix: str = "frame"):
+        """Write every changed frame from now on as a numbered PNG"""
+        os.makedirs(directory, exist_ok=True)
+        self._capture_dir = directory
+        self._capture_prefix = prefix
+        self.captured = 0
+    
+    def stop_capture(self) -> int:
+        """Stop writing frames, return how many were written"""
+        self._capture_dir = None
+        return self.captured
+    
+    def save(self, path: str):
+        self.image.save(path)
+
+class SessionRecorder:
+    """Writes input events and tick timings as JSON lines
+    
+    Every line carries a monotonic timestamp relative to the session start;
+    the first line is a header with the RNG seed and initial pet state.
+    """
+    def __init__(self, path: str, seed: int, initial_state: dict, clock=time.monotonic,
+                 rules: Optional[dict] = None):
+        self.path = path
+        self.clock = clock
+        self.start = clock()
+        self._file = None
+        try:
+            self._file = open(path, 'w', encoding='utf-8')
+            header = {"type": "session", "version": 1, "seed": seed, "state": initial_state}
+            if rules:
+                header["rules"] = rules
+            self._write(header)
+            print(f"Recording session to {path}")
+        except Exception as e:
+            print(f"Session recording failed: {e}")
+            self._file = None
+    
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    
+    def record(self, kind: str, t: Optional[float] = None, **data):
+        if not self._file:
+            return
+        if t is None:
+            t = self.clock()
+        entry = {"t": round(t - self.start, 6), "type": kind}
+        entry.update(data)
+        self._write(entry)
+    
+    def flush(self):
+        if self._file:
+            self._file.flush()
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+    
+    @staticmethod
+    def load(path: str) -> Tuple[dict, List[dict]]:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        if not lines or lines[0].get("type") != "session":
+            raise ValueError(f"{path} is not a recorded session")
+        return lines[0], lines[1:]
+
+class PetBehavior:
+    """Pet logic shared by the Tk window and headless replays
+    
+    Speech, actions and reactions live here so a recorded session replays
+    through exactly the same code as the live pet.
+    """
+    REACTIONS = ["Hehe!", "Tickles!", "More!", "Hahaha!"]
+    
+    def _init_behavior(self, state: PetState, scheduler: Scheduler, seed: int):
+        self.state = state
+        self.scheduler = scheduler
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.recorder: Optional[SessionRecorder] = None
+        self.speech_bubble: Optional[str] = None
+        self._speech_timer: Optional[TimerHandle] = None
+        self._action_timer: Optional[TimerHandle] = None
+    
+    def _record(self, kind: str, **data):
+        if self.recorder:
+            self.recorder.record(kind, **data)
+    
+    def wake(self):
+        pass
+    
+    def set_rules(self, rules: MoodRules):
+        self._record("rules", **rules.source)
+        self.state.rules = rules
+        self.state._update_mood()
+    
+    def step(self, ticks: int, now: float):
+        """Advance stats and run expired timers"""
+        self.state.update(ticks)
+        self.scheduler.run_due(now)
+    
+    def show_speech(self, text: str, duration: float = 2.0):
+        self.speech_bubble = text
+        if self._speech_timer:
+            self._speech_timer.cancel()
+        self._speech_timer = self.scheduler.call_later(duration, self._clear_speech)
+        self.wake()
+    
+    def _clear_speech(self):
+        self.speech_bubble = None
+        self._speech_timer = None
+    
+    def _set_action(self, action: Optional[str], duration: float):
+        self.state.action = action
+        if self._action_timer:
+            self._action_timer.cancel()
+        self._action_timer = self.scheduler.call_later(duration, self._clear_action)
+    
+    def _clear_action(self):
+        self.state.action = None
+        self._action_timer = None
+    
+    def say(self, text: str, duration: float = 2.0):
+        self._record("speak", text=text, duration=duration)
+        self.show_speech(text, duration)
+    
+    def pet_clicked(self):
+        self._record("click")
+        self.state.happiness = min(100, self.state.happiness + 5)
+        self.show_speech(self.rng.choice(self.REACTIONS))
+    
+    def announce_volume(self, volume: float):
+        self._record("volume", volume=volume)
+        self.show_speech(f"Volume: {int(volume * 100)}%", 1.5)
+    
+    def feed(self, food_name: str, satiation_gain: int):
+        self._record("feed", food=food_name, gain=satiation_gain)
+        self.state.feed(satiation_gain)
+        self._set_action(f"eating_{food_name}", 3.0)
+        self.show_speech(f"Yum! {food_name}!", 2.5)
+    
+    def play_action(self, play_name: str, happiness_gain: int):
+        self._record("play", play=play_name, gain=happiness_gain)
+        self.state.play(happiness_gain)
+        self._set_action(f"playing_{play_name}", 3.5)
+        self.show_speech(f"Let's {play_name}!", 2.5)
+    
+    def sleep_action(self):
+        self._record("sleep")
+        self.state.sleep()
+        self._set_action(self.state.action, 6.0)
+        self.show_speech("Zzz... Sweet dreams", 3.0)
+    
+    def status_text(self) -> str:
+        return (
+            f"Hunger: {self.state.satiation:.0f}/100  "
+            f"Energy: {self.state.energy:.0f}/100\n"
+            f"Happy: {self.state.happiness:.0f}/100"
+        )
+    
+    def get_current_mood_key(self) -> str:
+        if self.state.action:
+            if self.state.action.startswith("eating_"):
+                return "happy"
+            elif self.state.action.startswith("playing_"):
+                return "excited"
+        return self.state.mood.value
+
+class HeadlessPet(PetBehavior):
+    """Window-less pet on a virtual clock, used to replay recorded sessions"""
+    def __init__(self, seed: int = 0, initial_state: Optional[dict] = None,
+                 rules: Optional[MoodRules] = None):
+        self.now = 0.0
+        state = PetState(data_file=None, rules=rules)
+        if initial_state:
+            state.load_dict(initial_state)
+        self._init_behavior(state, Scheduler(clock=lambda: self.now), seed)
+        self.weather_data: Optional[dict] = None
+        self.ticks = 0
+        self.tick_ms: List[float] = []
+        self.renderer: Optional[OffscreenRenderer] = None
+        self.handlers = {
+            "tick": lambda e: self._replay_tick(e["ticks"]),
+            "click": lambda e: self.pet_clicked(),
+            "feed": lambda e: self.feed(e["food"], e["gain"]),
+            "play": lambda e: self.play_action(e["play"], e["gain"]),
+            "sleep": lambda e: self.sleep_action(),
+            "speak": lambda e: self.say(e["text"], e["duration"]),
+            "volume": lambda e: self.announce_volume(e["volume"]),
+            "weather": lambda e: setattr(self, "weather_data", e["data"]),
+            "rules": lambda e: self.set_rules(MoodRules(e["mood_rules"], e["action_effects"])),
+        }
+    
+    def _replay_tick(self, ticks: int):
+        started = time.perf_counter()
+        self.step(ticks, self.now)
+        if self.renderer:
+            self.renderer.render(self.get_current_mood_key(), self.ticks,
+                                 self.speech_bubble, self.status_text())
+        self.tick_ms.append((time.perf_counter() - started) * 1000)
+        self.ticks += ticks
+    
+    def replay(self, events: List[dict]) -> dict:
+        """Run events at full speed and report per-tick cost and final state"""
+        recorded_ms = []
+        # Timestamps, not file order, define the sequence: a tick is
+        # written after it finishes but stamped when it started
+        for event in sorted(events, key=lambda e: e["t"]):
+            self.now = event["t"]
+            if event["type"] == "tick":
+                recorded_ms.append(event.get("ms", 0.0))
+            handler = self.handlers.get(event["type"])
+            if handler:
+                handler(event)
+        return {
+            "events": len(events),
+            "ticks": self.ticks,
+            "recorded_tick_ms": timing_summary(recorded_ms),
+            "replay_tick_ms": timing_summary(self.tick_ms),
+            "final_state": self.state.to_dict(),
+            "mood_key": self.get_current_mood_key(),
+        }
+
+def timing_summary(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+def offscreen_renderer(gif_files: Dict[str, str], size: int) -> OffscreenRenderer:
+    """Offscreen renderer fed straight from the GIFs, no Tk needed"""
+    store = FrameStore()
+    source_frames = {
+        mood: store.load_gif(path) for mood, path in gif_files.items() if os.path.exists(path)
+    }
+    resized = store.resize_all(
+        (key for keys in source_frames.values() for key in keys),
+        size, Image.Resampling.LANCZOS
+    )
+    
+    def frame_source(mood_key: str, animation_frame: int) -> Optional[Image.Image]:
+        keys = source_frames.get(mood_key, source_frames.get("normal"))
+        if not keys:
+            return None
+        return resized[keys[(animation_frame // Constants.FRAME_SPEED) % len(keys)]]
+    
+    return OffscreenRenderer(size, frame_source)
+
+def replay_session(path: str, gif_files: Optional[Dict[str, str]] = None,
+                   export_dir: Optional[str] = None, size: int = 150) -> dict:
+    """Replay a recorded session headlessly and return its report
+    
+    With export_dir, every changed frame is composited offscreen and
+    written there as PNG, plus the final frame as final.png.
+    """
+    header, events = SessionRecorder.load(path)
+    rules = header.get("rules")
+    if rules:
+        rules = MoodRules(rules["mood_rules"], rules["action_effects"])
+    pet = HeadlessPet(header.get("seed", 0), header.get("state"), rules)
+    if export_dir and gif_files:
+        pet.renderer = offscreen_renderer(gif_files, size)
+        pet.renderer.start_capture(export_dir)
+    report = pet.replay(events)
+    if pet.renderer:
+        report["exported_frames"] = pet.renderer.stop_capture()
+        pet.renderer.save(os.path.join(export_dir, "final.png"))
+    return report
+
+class DesktopPet(PetBehavior):
     """Desktop pet main class"""
     def __init__(self, gif_files: Dict[str, str], config: Optional[Config] = None):
         self.config = config or Config()
         self.pet_size = self.config.get("pet_size", 150)
+        self.scheduler = Scheduler()
         
         # Initialize audio
         self.audio = AudioManager(
@@ -648,29 +2551,61 @@ class DesktopPet:
         self.window = tk.Tk()
         self._setup_window()
         
+        # Power saving state; frame swaps below may already wake the loop
+        self._after_id: Optional[str] = None
+        self._last_tick_time = time.monotonic()
+        self._window_visible = True
+        self._idle_sleeping = False
+        
         # Load images
-        self.pet_images: Dict[str, List[ImageTk.PhotoImage]] = {}
+        self.gif_files = gif_files
+        self.source_store = FrameStore()
+        self.source_frames: Dict[str, List[str]] = {}
+        self.frame_set: Optional[FrameSet] = None
+        self.frame_sets: "OrderedDict[int, FrameSet]" = OrderedDict()
+        self.tinted_sets: "OrderedDict[Tuple[int, str], FrameSet]" = OrderedDict()
+        self.tint_condition = "clear"
+        self.weather_service: Optional[WeatherService] = None
+        self._hq_results: queue.Queue = queue.Queue()
+        self._hq_generation = 0
         self.load_gifs(gif_files)
         
-        if not self.pet_images:
+        if not self.frame_set or self.frame_set.is_empty():
             print("Error: No images loaded")
             self.window.destroy()
             return
         
         # Initialize state and services
-        self.state = PetState()
+        self._init_behavior(PetState(rules=MoodRules.from_config(self.config)),
+                            self.scheduler, random.randrange(2 ** 32))
+        record_path = self.config.get("record_session")
+        if record_path:
+            self.recorder = SessionRecorder(record_path, self.seed, self.state.to_dict(),
+                                            rules=self.state.rules.source)
+        self.history = StatsHistory()
         self.weather_service = None
         if self.config.get("enable_weather", True):
             self.weather_service = WeatherService(
                 self.config.get("latitude", Constants.DEFAULT_LATITUDE),
                 self.config.get("longitude", Constants.DEFAULT_LONGITUDE)
             )
-            self.weather_service.fetch_weather()
+            self._fetch_weather()
+        
+        # Local control API
+        self.ipc: Optional[IpcServer] = None
+        if self.config.get("enable_ipc", False):
+            self.set_ipc(True)
+        
+        # Timers
+        self.scheduler.call_later(Constants.SAVE_INTERVAL, self._autosave)
+        self.scheduler.call_later(Constants.CONFIG_CHECK_INTERVAL, self._check_config)
+        self.scheduler.call_later(0, self._sample_history)
+        self._schedule_weather_refresh()
         
         # UI elements
         self.animation_frame = 0
-        self.speech_bubble: Optional[str] = None
-        self.speech_timer: int = 0
+        self.bubbles = SpeechBubbleRenderer()
+        self.renderer = TkRenderer(self)
         
         # Interaction state
         self.is_dragging = False
@@ -678,15 +2613,36 @@ class DesktopPet:
         self.drag_start_y = 0
         self.last_click_time = 0
         
+        # Window motion, tracked locally and applied once per display frame
+        self.window_x = 0.0
+        self.window_y = 0.0
+        self._drag_window_x = 0
+        self._drag_window_y = 0
+        self._pointer: Optional[Tuple[int, int]] = None
+        self._drag_samples: deque = deque(maxlen=8)
+        self._velocity: Optional[Tuple[float, float]] = None
+        self._motion_after: Optional[str] = None
+        self._motion_resting = False
+        self._last_motion_time = time.monotonic()
+        self.screen_width = self.window.winfo_screenwidth()
+        self.screen_height = self.window.winfo_screenheight()
+        self.wander: Optional[WanderEngine] = None
+        
         # Bind events
         self.canvas.bind("<Button-1>", self.on_click)
         self.canvas.bind("<B1-Motion>", self.on_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_release)
+        self.canvas.bind("<Visibility>", self.on_visibility)
+        self.window.bind("<Map>", self.on_map)
+        self.window.bind("<Unmap>", self.on_map)
         
         # Bind weather label click
         self.status_label.bind("<Button-1>", self.show_weather_window)
         self.status_label.config(cursor="hand2")
         
+        if self.config.get("wander", False):
+            self.window.after_idle(self.set_wander, True)
+        
         # Start animation
         self.animate()
     
@@ -741,34 +2697,283 @@ class DesktopPet:
                 continue
             
             try:
-                gif = Image.open(filepath)
-                frames = []
-                
-                i = 0
-                while True:
-                    try:
-                        gif.seek(i)
-                        frame = gif.convert("RGBA")
-                        frame = frame.resize(
-                            (self.pet_size, self.pet_size),
-                            Image.Resampling.LANCZOS
-                        )
-                        photo = ImageTk.PhotoImage(frame)
-                        frames.append(photo)
-                        i += 1
-                    except EOFError:
-                        break
-                
+                frames = self.source_store.load_gif(filepath)
                 if frames:
-                    self.pet_images[mood] = frames
+                    self.source_frames[mood] = frames
                     print(f"Loaded {mood}: {len(frames)} frames")
                     
             except Exception as e:
                 print(f"Load failed {filepath}: {e}")
+        
+        store = self.source_store
+        print(f"Frame store: {store.unique_frames}/{store.total_frames} unique frames, "
+              f"{store.bytes_saved // 1024} KB saved")
+        self._build_frames()
     
-    def show_speech(self, text: str, duration: int = 40):
-        self.speech_bubble = text
-        self.speech_timer = duration
+    def _resize_sources(self, size: int, resample) -> Dict[str, Image.Image]:
+        keys = (key for keys in self.source_frames.values() for key in keys)
+        return self.source_store.resize_all(keys, size, resample)
+    
+    def _cache_frame_set(self, frame_set: FrameSet):
+        self.frame_sets[frame_set.size] = frame_set
+        self.frame_sets.move_to_end(frame_set.size)
+        while len(self.frame_sets) > Constants.FRAME_CACHE_SIZES:
+            self.frame_sets.popitem(last=False)
+    
+    def _build_frames(self):
+        """Build high quality frames for pet_size without decoding the GIFs again"""
+        self.frame_sets.clear()
+        self.tinted_sets.clear()
+        self._hq_generation += 1
+        self.frame_set = FrameSet(
+            self.pet_size,
+            self.source_frames,
+            self._resize_sources(self.pet_size, Image.Resampling.LANCZOS),
+            self.config.get("sprite_atlas", "off")
+        )
+        self._cache_frame_set(self.frame_set)
+        self._update_tint()
+    
+    def _update_tint(self):
+        """Show the variant for the current weather, building it at most once
+        
+        Every frame set swap ends here, so this also wakes a sleeping loop
+        to draw the new frames right away.
+        """
+        base = self.frame_sets.get(self.pet_size)
+        if base is None:
+            return
+        condition = "clear"
+        if self.config.get("weather_tint", True) and self.weather_service:
+            condition = WeatherTint.condition(self.weather_service.weather_data)
+        self.tint_condition = condition
+        matrix = WeatherTint.matrix(condition)
+        if matrix is None:
+            self.frame_set = base
+            self.wake()
+            return
+        
+        key = (self.pet_size, condition)
+        tinted = self.tinted_sets.get(key)
+        if tinted is None or tinted.high_quality != base.high_quality:
+            # Tint each unique frame once and keep frames shared as in the base set
+            unique = base.frames()
+            tinted_frames = dict(zip(unique, WeatherTint.apply_all(list(unique.values()), matrix)))
+            tinted = FrameSet(
+                self.pet_size,
+                self.source_frames,
+                {k: tinted_frames[digest] for k, digest in base.frame_keys.items()},
+                self.config.get("sprite_atlas", "off"),
+                high_quality=base.high_quality
+            )
+            self.tinted_sets[key] = tinted
+            while len(self.tinted_sets) > Constants.TINT_CACHE_SIZE:
+                self.tinted_sets.popitem(last=False)
+        self.tinted_sets.move_to_end(key)
+        self.frame_set = tinted
+        self.wake()
+    
+    def set_pet_size(self, size: int):
+        """Resize live: cheap frames now, LANCZOS frames as a background job finishes them"""
+        size = int(size)
+        if size == self.pet_size and self.frame_set:
+            return
+        self._record("size", size=size)
+        self.pet_size = size
+        self.config.set("pet_size", size)
+        self._resize_window()
+        
+        self._hq_generation += 1
+        frame_set = self.frame_sets.get(size)
+        if frame_set is None:
+            frame_set = FrameSet(
+                size,
+                self.source_frames,
+                self._resize_sources(size, Image.Resampling.BILINEAR),
+                self.config.get("sprite_atlas", "off"),
+                high_quality=False
+            )
+        self._cache_frame_set(frame_set)
+        self.frame_set = frame_set
+        self._update_tint()
+        
+        if not frame_set.high_quality:
+            threading.Thread(
+                target=self._resize_hq_worker,
+                args=(size, list(frame_set.frame_keys), self._hq_generation),
+                daemon=True
+            ).start()
+    
+    def _resize_hq_worker(self, size: int, keys: List[str], generation: int):
+        """Background thread: only PIL work here, Tk images are made on the main thread"""
+        for key in keys:
+            if generation != self._hq_generation:
+                return
+            frame = self.source_store.get(key).resize((size, size), Image.Resampling.LANCZOS)
+            self._hq_results.put((generation, size, key, frame))
+        self._hq_results.put((generation, size, None, None))
+    
+    def _apply_hq_frames(self):
+        """Swap in finished high quality frames, a few per tick"""
+        for _ in range(Constants.HQ_FRAMES_PER_TICK):
+            try:
+                generation, size, key, frame = self._hq_results.get_nowait()
+            except queue.Empty:
+                return
+            frame_set = self.frame_sets.get(size)
+            if generation != self._hq_generation or frame_set is None:
+                continue
+            if key is None:
+                frame_set.high_quality = True
+                if frame_set is not self.frame_set and size == self.pet_size:
+                    # A tinted variant is showing; rebuild it from the sharp frames
+                    self._update_tint()
+            else:
+                frame_set.replace(key, frame)
+    
+    def _resize_window(self):
+        self.canvas_width = self.pet_size + 100
+        self.canvas_height = self.pet_size
+        self.window.geometry(f"{self.canvas_width}x{self.canvas_height+80}")
+        self.canvas.config(width=self.canvas_width, height=self.canvas_height)
+        if self.wander:
+            self.wander.set_window_size(self.canvas_width, self.canvas_height + 80)
+    
+    def apply_config_changes(self, changes: dict):
+        """Update only the subsystems affected by changed config keys"""
+        if not changes:
+            return
+        print(f"Config changed: {', '.join(sorted(changes))}")
+        
+        # One failing subsystem must not keep the others from updating
+        def apply(name: str, update, *args):
+            try:
+                update(*args)
+            except Exception as e:
+                print(f"Applying {name} failed: {e}")
+        
+        if "sprite_atlas" in changes:
+            apply("sprite_atlas", self._apply_sprite_atlas)
+        elif "pet_size" in changes:
+            apply("pet_size", self.set_pet_size, changes["pet_size"])
+        
+        if "enable_ipc" in changes or "ipc_socket" in changes:
+            apply("enable_ipc", self.set_ipc, bool(self.config.get("enable_ipc", False)))
+        
+        if "wander" in changes:
+            apply("wander", self.set_wander, bool(changes["wander"]))
+        
+        if "window_topmost" in changes:
+            apply("window_topmost", self.window.attributes, '-topmost', changes["window_topmost"])
+        
+        if "pet_name" in changes:
+            apply("pet_name", self.window.title, changes["pet_name"])
+        
+        if "sfx_volume" in changes:
+            apply("sfx_volume", self.audio.set_sfx_volume, changes["sfx_volume"])
+        if "bgm_volume" in changes:
+            apply("bgm_volume", self.audio.set_bgm_volume, changes["bgm_volume"])
+        if "enable_bgm" in changes:
+            if changes["enable_bgm"]:
+                apply("enable_bgm", self.audio.play_bgm)
+            else:
+                apply("enable_bgm", self.audio.stop_bgm)
+        
+        if "mood_rules" in changes or "action_effects" in changes:
+            apply("mood_rules", lambda: self.set_rules(MoodRules.from_config(self.config)))
+        
+        if "weather_tint" in changes:
+            apply("weather_tint", self._update_tint)
+        
+        if "enable_weather" in changes or "latitude" in changes or "longitude" in changes:
+            apply("weather", self._apply_weather_config, changes)
+        
+        # foods, plays and location_name are read on demand by the menu and
+        # weather window, so they need no extra work here
+    
+    def _apply_sprite_atlas(self):
+        self.pet_size = self.config.get("pet_size", self.pet_size)
+        self._resize_window()
+        self._build_frames()
+    
+    def _apply_weather_config(self, changes: dict):
+        if "enable_weather" in changes:
+            if not changes["enable_weather"]:
+                self.weather_service = None
+                self._update_tint()
+            elif not self.weather_service:
+                self.weather_service = WeatherService(
+                    self.config.get("latitude", Constants.DEFAULT_LATITUDE),
+                    self.config.get("longitude", Constants.DEFAULT_LONGITUDE)
+                )
+                self._fetch_weather()
+        elif self.weather_service:
+            self.weather_service.latitude = self.config.get("latitude", Constants.DEFAULT_LATITUDE)
+            self.weather_service.longitude = self.config.get("longitude", Constants.DEFAULT_LONGITUDE)
+            self._fetch_weather()
+    
+    def _autosave(self):
+        self.state.save_data()
+        self.history.save_data()
+        if self.recorder:
+            self.recorder.flush()
+        self.scheduler.call_later(Constants.SAVE_INTERVAL, self._autosave)
+    
+    def set_ipc(self, enabled: bool):
+        """Start or stop the local control API"""
+        if self.ipc:
+            self.ipc.stop()
+            self.ipc = None
+        if enabled:
+            ipc = IpcServer(self, self.config.get("ipc_socket", "pet.sock"))
+            if ipc.start():
+                self.ipc = ipc
+    
+    def _sample_history(self):
+        self.history.record(self.state)
+        self.scheduler.call_later(Constants.HISTORY_SAMPLE_INTERVAL, self._sample_history)
+    
+    def show_history_window(self):
+        HistoryWindow(self.window, self.history)
+    
+    def _check_config(self):
+        # Reschedule first so a bad edit can never stop the watcher
+        self.scheduler.call_later(Constants.CONFIG_CHECK_INTERVAL, self._check_config)
+        self.apply_config_changes(self.config.reload_if_changed())
+    
+    def _schedule_weather_refresh(self):
+        interval = Constants.WEATHER_UPDATE_INTERVAL
+        if self.weather_service and not self.weather_service.weather_data:
+            interval = Constants.WEATHER_RETRY_INTERVAL
+        self.scheduler.call_later(interval, self._refresh_weather)
+    
+    def _fetch_weather(self):
+        if self.weather_service.fetch_weather():
+            self._record("weather", data=self.weather_service.weather_data)
+            self._update_tint()
+    
+    def _refresh_weather(self):
+        if self.weather_service:
+            self._fetch_weather()
+        self._schedule_weather_refresh()
+    
+    def wake(self):
+        """Run the next tick now if the loop is sleeping in power saving mode"""
+        if not self._idle_sleeping or self._after_id is None:
+            return
+        self._idle_sleeping = False
+        self.window.after_cancel(self._after_id)
+        self._after_id = self.window.after_idle(self.animate)
+    
+    def on_map(self, event):
+        if event.widget is not self.window:
+            return
+        self._window_visible = event.type == tk.EventType.Map
+        self.wake()
+    
+    def on_visibility(self, event):
+        self._window_visible = event.state != "VisibilityFullyObscured"
+        self.wake()
     
     def show_weather_window(self, event=None):
         """Show weather detail window"""
@@ -780,32 +2985,161 @@ class DesktopPet:
         current_time = time.time()
         
         if current_time - self.last_click_time < Constants.DOUBLE_CLICK_TIME:
+            self._record("menu")
             self.show_menu()
             self.last_click_time = 0
         else:
             self.is_dragging = True
-            self.drag_start_x = event.x_root
-            self.drag_start_y = event.y_root
-            self.state.happiness = min(100, self.state.happiness + 5)
+            self._start_drag(event)
             self.last_click_time = current_time
             
             self.audio.play_click()
-            
-            reactions = ["Hehe!", "Tickles!", "More!", "Hahaha!"]
-            self.show_speech(random.choice(reactions))
+            self.pet_clicked()
     
     def on_drag(self, event):
+        # Only record the pointer; the window moves at most once per frame
         if self.is_dragging:
-            dx = event.x_root - self.drag_start_x
-            dy = event.y_root - self.drag_start_y
-            x = self.window.winfo_x() + dx
-            y = self.window.winfo_y() + dy
-            self.window.geometry(f"+{x}+{y}")
-            self.drag_start_x = event.x_root
-            self.drag_start_y = event.y_root
+            self._record("drag", x=event.x_root, y=event.y_root)
+            self._pointer = (event.x_root, event.y_root)
+            self._drag_samples.append((time.monotonic(), event.x_root, event.y_root))
+            self._schedule_motion()
     
     def on_release(self, event):
+        self._record("release", x=event.x_root, y=event.y_root)
         self.is_dragging = False
+        if self.config.get("drag_momentum", False):
+            self._velocity = self._release_velocity()
+        if self.wander and not self._velocity:
+            self._apply_pointer()
+            self.wander.start(self.window_x, self.window_y, time.monotonic())
+        if self._velocity or self.wander:
+            self._last_motion_time = time.monotonic()
+            self._schedule_motion()
+        self._drag_samples.clear()
+    
+    def _start_drag(self, event):
+        self._velocity = None
+        self.window_x = self.window.winfo_x()
+        self.window_y = self.window.winfo_y()
+        self._drag_window_x = self.window_x
+        self._drag_window_y = self.window_y
+        self.drag_start_x = event.x_root
+        self.drag_start_y = event.y_root
+        self._drag_samples.clear()
+        self._drag_samples.append((time.monotonic(), event.x_root, event.y_root))
+    
+    def _release_velocity(self) -> Optional[Tuple[float, float]]:
+        """Pointer velocity in px/s over the last few motion events"""
+        if len(self._drag_samples) < 2:
+            return None
+        t1, x1, y1 = self._drag_samples[-1]
+        recent = [s for s in self._drag_samples if t1 - s[0] <= Constants.MOMENTUM_SAMPLE_WINDOW]
+        t0, x0, y0 = recent[0]
+        if t1 - t0 <= 0:
+            return None
+        vx = (x1 - x0) / (t1 - t0)
+        vy = (y1 - y0) / (t1 - t0)
+        speed = math.hypot(vx, vy)
+        if speed < Constants.MOMENTUM_MIN_SPEED:
+            return None
+        if speed > Constants.MOMENTUM_MAX_SPEED:
+            scale = Constants.MOMENTUM_MAX_SPEED / speed
+            vx, vy = vx * scale, vy * scale
+        return (vx, vy)
+    
+    def _schedule_motion(self, delay_ms: int = Constants.MOTION_FRAME_DELAY):
+        if self._motion_after is not None:
+            if not self._motion_resting or delay_ms > Constants.MOTION_FRAME_DELAY:
+                return
+            # Drag or momentum needs frames now, not at the end of a rest
+            self.window.after_cancel(self._motion_after)
+        self._motion_resting = delay_ms > Constants.MOTION_FRAME_DELAY
+        self._motion_after = self.window.after(delay_ms, self._motion_step)
+    
+    def _move_window(self, x: float, y: float):
+        old_x, old_y = round(self.window_x), round(self.window_y)
+        self.window_x, self.window_y = x, y
+        if (round(x), round(y)) != (old_x, old_y):
+            self.window.geometry(f"+{round(x)}+{round(y)}")
+    
+    def _apply_pointer(self):
+        """Move the window to follow the latest recorded drag pointer"""
+        if self._pointer is None:
+            return
+        x = self._drag_window_x + self._pointer[0] - self.drag_start_x
+        y = self._drag_window_y + self._pointer[1] - self.drag_start_y
+        self._pointer = None
+        self._move_window(x, y)
+    
+    def _motion_step(self):
+        """Per-frame motion step: coalesced drag position, momentum or wandering"""
+        self._motion_after = None
+        now = time.monotonic()
+        dt = min(now - self._last_motion_time, 0.1)
+        self._last_motion_time = now
+        
+        if self._pointer is not None:
+            self._apply_pointer()
+            if not self.is_dragging:
+                self._schedule_motion()
+            return
+        
+        if self.is_dragging:
+            return
+        
+        if self._velocity:
+            self._momentum_step(dt)
+            if not self._velocity and self.wander:
+                self.wander.start(self.window_x, self.window_y, now)
+            self._schedule_motion()
+        elif self.wander:
+            self._move_window(*self.wander.position(self.state, now))
+            if self.wander.moving:
+                self._schedule_motion()
+            else:
+                # Idle or perched: nothing moves until the segment ends
+                self._schedule_motion(max(Constants.MOTION_FRAME_DELAY,
+                                          math.ceil((self.wander.segment_end - now) * 1000)))
+    
+    def _momentum_step(self, dt: float):
+        vx, vy = self._velocity
+        x = self.window_x + vx * dt
+        y = self.window_y + vy * dt
+        
+        # Bounce off the screen edges
+        max_x = self.screen_width - self.canvas_width
+        max_y = self.screen_height - (self.canvas_height + 80)
+        if x < 0 or x > max_x:
+            x = max(0, min(max_x, x))
+            vx = -vx * Constants.MOMENTUM_BOUNCE
+        if y < 0 or y > max_y:
+            y = max(0, min(max_y, y))
+            vy = -vy * Constants.MOMENTUM_BOUNCE
+        self._move_window(x, y)
+        
+        decay = math.exp(-Constants.MOMENTUM_FRICTION * dt)
+        vx, vy = vx * decay, vy * decay
+        if math.hypot(vx, vy) < Constants.MOMENTUM_MIN_SPEED:
+            self._velocity = None
+        else:
+            self._velocity = (vx, vy)
+    
+    def set_wander(self, enabled: bool):
+        """Turn autonomous wandering on or off"""
+        self.config.set("wander", enabled)
+        if not enabled:
+            self.wander = None
+            return
+        if self.wander is None:
+            self.wander = WanderEngine(
+                self.screen_width, self.screen_height,
+                self.canvas_width, self.canvas_height + 80
+            )
+        self.window_x = self.window.winfo_x()
+        self.window_y = self.window.winfo_y()
+        self.wander.start(self.window_x, self.window_y, time.monotonic())
+        self._last_motion_time = time.monotonic()
+        self._schedule_motion()
     
     def show_menu(self):
         menu = tk.Menu(self.window, tearoff=0)
@@ -830,6 +3164,18 @@ class DesktopPet:
         
         menu.add_command(label="😴 Sleep", command=self.sleep_action)
         
+        size_menu = tk.Menu(menu, tearoff=0)
+        for size in Constants.PET_SIZES:
+            size_menu.add_command(
+                label=f"{size}px" + (" ✓" if size == self.pet_size else ""),
+                command=lambda s=size: self.set_pet_size(s)
+            )
+        menu.add_cascade(label="📏 Size", menu=size_menu)
+        menu.add_command(
+            label="🚶 Stop wandering" if self.wander else "🚶 Wander",
+            command=lambda: self.set_wander(not self.wander)
+        )
+        
         if self.audio.enable_audio:
             menu.add_separator()
             audio_menu = tk.Menu(menu, tearoff=0)
@@ -842,6 +3188,8 @@ class DesktopPet:
         
         menu.add_separator()
         menu.add_command(label="🌤️ Weather", command=self.show_weather_window)
+        menu.add_command(label="📈 History", command=self.show_history_window)
+        menu.add_command(label="📷 Snapshot", command=self.export_snapshot)
         menu.add_command(label="❌ Exit", command=self.quit_app)
         
         try:
@@ -855,119 +3203,102 @@ class DesktopPet:
         self.audio.set_sfx_volume(new_volume)
         self.config.set("bgm_volume", new_volume)
         self.config.set("sfx_volume", new_volume)
-        self.show_speech(f"Volume: {int(new_volume * 100)}%", 30)
-    
-    def feed(self, food_name: str, satiation_gain: int):
-        self.state.feed(satiation_gain)
-        self.state.action = f"eating_{food_name}"
-        self.state.action_timer = 60
-        self.show_speech(f"Yum! {food_name}!", 50)
-    
-    def play_action(self, play_name: str, happiness_gain: int):
-        self.state.play(happiness_gain)
-        self.state.action = f"playing_{play_name}"
-        self.state.action_timer = 70
-        self.show_speech(f"Let's {play_name}!", 50)
-    
-    def sleep_action(self):
-        self.state.sleep()
-        self.state.action_timer = 120
-        self.show_speech("Zzz... Sweet dreams", 60)
+        self.announce_volume(new_volume)
     
     def quit_app(self):
+        if self.ipc:
+            self.ipc.stop()
         self.audio.stop_bgm()
         self.state.save_data()
+        self.history.save_data()
         self.config.save_config()
+        if self.recorder:
+            self.recorder.close()
         self.window.quit()
     
-    def get_current_mood_key(self) -> str:
-        if self.state.action:
-            if self.state.action.startswith("eating_"):
-                return "happy"
-            elif self.state.action.startswith("playing_"):
-                return "excited"
-        return self.state.mood.value
-    
     def draw(self):
-        self.canvas.delete("all")
-        
-        mood_key = self.get_current_mood_key()
-        frames = self.pet_images.get(mood_key, self.pet_images.get("normal", None))
-        
-        if frames:
-            frame_index = (self.animation_frame // Constants.FRAME_SPEED) % len(frames)
-            self.canvas.create_image(
-                self.canvas_width // 2,
-                self.canvas_height // 2,
-                image=frames[frame_index]
-            )
-        
-        if self.speech_bubble and self.speech_timer > 0:
-            self._draw_speech_bubble()
-            self.speech_timer -= 1
-        
-        self._update_status_label()
-    
-    def _draw_speech_bubble(self):
-        bubble_x = self.canvas_width // 2 + 40
-        bubble_y = 30
-        
-        self.canvas.create_oval(
-            bubble_x - 45, bubble_y - 16,
-            bubble_x + 45, bubble_y + 16,
-            fill=Constants.BUBBLE_BG, 
-            outline=Constants.BUBBLE_OUTLINE, 
-            width=2
-        )
-        
-        self.canvas.create_polygon(
-            bubble_x - 25, bubble_y + 16,
-            bubble_x - 35, bubble_y + 27,
-            bubble_x - 15, bubble_y + 18,
-            fill=Constants.BUBBLE_BG, 
-            outline=Constants.BUBBLE_OUTLINE
-        )
-        
-        self.canvas.create_text(
-            bubble_x, bubble_y,
-            text=self.speech_bubble,
-            font=("Helvetica", 9, "bold"),
-            fill=Constants.BUBBLE_TEXT_COLOR,
-            width=80
+        self.renderer.render(
+            self.get_current_mood_key(),
+            self.animation_frame,
+            self.speech_bubble,
+            self.status_text()
         )
     
-    def _update_status_label(self):
+    def bubble_position(self) -> Tuple[int, int]:
+        """Top-left corner of the bubble image on the canvas"""
+        return (self.canvas_width // 2 + 40 - SpeechBubbleRenderer.CENTER_X,
+                30 - SpeechBubbleRenderer.CENTER_Y)
+    
+    def status_text(self) -> str:
         status_text = ""
         
         if self.weather_service:
             weather_msg = self.weather_service.get_weather_description()
             status_text += f"{weather_msg} (Click for details)\n"
         
-        status_text += (
-            f"Hunger: {self.state.satiation:.0f}/100  "
-            f"Energy: {self.state.energy:.0f}/100\n"
-            f"Happy: {self.state.happiness:.0f}/100"
-        )
+        status_text += super().status_text()
         
         if self.audio.enable_audio:
             status_text += f"  🔊 {int(self.audio.bgm_volume * 100)}%"
         
-        self.status_label.config(text=status_text)
+        return status_text
+    
+    def export_snapshot(self, path: str = "pet_snapshot.png"):
+        """Composite the current scene offscreen and save it as an image"""
+        renderer = OffscreenRenderer(self.pet_size, self.frame_set.pil_frame, self.bubbles)
+        renderer.render(self.get_current_mood_key(), self.animation_frame,
+                        self.speech_bubble, self.status_text())
+        try:
+            renderer.save(path)
+            self.show_speech("Say cheese!", 1.5)
+        except Exception as e:
+            print(f"Snapshot failed: {e}")
+    
+    def _next_delay(self) -> int:
+        """Milliseconds until the next tick, longer when nothing can change on screen"""
+        self._idle_sleeping = False
+        if not self.config.get("power_saving", False):
+            return Constants.ANIMATION_DELAY
+        if self.is_dragging or not self.frame_set.high_quality:
+            return Constants.ANIMATION_DELAY
+        
+        if self._window_visible:
+            if self.speech_bubble:
+                return Constants.ANIMATION_DELAY
+            if self.frame_set.frame_count(self.get_current_mood_key()) > 1:
+                return Constants.ANIMATION_DELAY
+        
+        # Static or hidden: sleep until the next predicted change or deadline
+        delay_ms = self.state.ticks_until_change() * Constants.ANIMATION_DELAY
+        deadline = self.scheduler.next_deadline()
+        if deadline is not None:
+            delay_ms = min(delay_ms, (deadline - time.monotonic()) * 1000)
+        self._idle_sleeping = True
+        return int(max(Constants.ANIMATION_DELAY, min(delay_ms, Constants.IDLE_MAX_DELAY)))
     
     def animate(self):
-        self.state.update()
+        # Stats decay per nominal tick of real time, so a slow or skipped
+        # tick catches up instead of stretching everything out
+        now = time.monotonic()
+        elapsed_ms = (now - self._last_tick_time) * 1000
+        ticks = max(1, round(elapsed_ms / Constants.ANIMATION_DELAY))
+        self._last_tick_time = now
         
-        if self.animation_frame % Constants.SAVE_INTERVAL == 0:
-            self.state.save_data()
+        self.step(ticks, now)
+        if self.ipc:
+            self.ipc.publish_state()
+        self._apply_hq_frames()
         
-        if self.weather_service and self.weather_service.should_update():
-            self.weather_service.fetch_weather()
+        if self._window_visible or not self.config.get("power_saving", False):
+            self.draw()
         
-        self.draw()
+        self.animation_frame += ticks
         
-        self.animation_frame += 1
+        if self.recorder:
+            self.recorder.record("tick", t=now, ticks=ticks,
+                                 ms=round((time.monotonic() - now) * 1000, 3))
         
-        self.window.after(Constants.ANIMATION_DELAY, self.animate)
+        self._after_id = self.window.after(self._next_delay(), self.animate)
     
     def run(self):
         try:
@@ -975,9 +3306,14 @@ class DesktopPet:
         except Exception as e:
             print(f"Runtime error: {e}")
         finally:
+            if self.ipc:
+                self.ipc.stop()
             self.audio.stop_bgm()
             self.state.save_data()
+            self.history.save_data()
             self.config.save_config()
+            if self.recorder:
+                self.recorder.close()
 
 def main():
     """Main function"""
@@ -991,6 +3327,12 @@ def main():
         "most_angry": "luchen most angry.GIF"
     }
     
+    if len(sys.argv) >= 3 and sys.argv[1] == "--replay":
+        export_dir = sys.argv[3] if len(sys.argv) >= 4 else None
+        size = Config().get("pet_size", 150)
+        print(json.dumps(replay_session(sys.argv[2], gif_files, export_dir, size), indent=2))
+        return
+    
     try:
         config = Config()
         pet = DesktopPet(gif_files, config)